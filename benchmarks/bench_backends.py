@@ -0,0 +1,135 @@
+"""
+Compares the inference backends of the yolo5 service: latency, and parity of the detections with the torch backend.
+Needs the yolo5 service environment (yolov5, torch, onnxruntime, the yolov5s.pt weights), and runs from the yolov5
+checkout like the service, e.g. in its image, on the sample images bundled with yolov5 (data/images) by default:
+
+    docker run --rm -v $PWD/benchmarks:/usr/src/benchmarks yolo5 python3 /usr/src/benchmarks/bench_backends.py
+
+    python benchmarks/bench_backends.py --corpus images/ --backends torch onnx onnx-int8 --batch-sizes 1 8 \\
+        --output results/backends.json
+
+For every image, the detections of a backend are matched to the torch ones (same class, IoU >= --iou).
+The match rate is the share of the detections of either side that found a match, the script exits with an error
+if the match rate of a backend is below its tolerance (--min-match, --min-match-int8 for quantized models).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from common import ROOT, compare, load_corpus, load_json, percentiles, save_results
+
+# the service modules, and yolov5 from the working directory
+sys.path[:0] = [str(ROOT / 'yolo5'), os.getcwd()]
+import cv2  # noqa: E402
+from engine import InferenceEngine  # noqa: E402
+
+
+def box_iou(a, b):
+    """IoU of every box of a with every box of b, boxes as (x1, y1, x2, y2)"""
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def match(reference, detections, iou_threshold):
+    """
+    Greedily matches the detections to the reference ones, highest confidence first.
+    :return: tuple of (number of matches, list of the confidence differences of the matches)
+    """
+    if not len(reference) or not len(detections):
+        return 0, []
+    ious = box_iou(detections.xyxy, reference.xyxy)
+    ious[detections.cls[:, None] != reference.cls[None, :]] = 0
+    matched, conf_diffs = set(), []
+    for i in np.argsort(-detections.conf):
+        candidates = [j for j in np.argsort(-ious[i]) if ious[i, j] >= iou_threshold and j not in matched]
+        if candidates:
+            matched.add(candidates[0])
+            conf_diffs.append(abs(float(detections.conf[i] - reference.conf[candidates[0]])))
+    return len(matched), conf_diffs
+
+
+def run(engine, images, batch_size):
+    """Predicts all images in batches, returns the detections and the per image latencies in ms"""
+    detections, latencies = [], []
+    for i in range(0, len(images), batch_size):
+        batch = images[i:i + batch_size]
+        start = time.perf_counter()
+        results, _ = engine.predict(batch)
+        latencies.extend([(time.perf_counter() - start) * 1000 / len(batch)] * len(batch))
+        detections.extend(results)
+    return detections, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default='data/images', help='directory of .jpg/.png images')
+    parser.add_argument('--weights', default='yolov5s.pt')
+    parser.add_argument('--data', default='data/coco128.yaml')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--backends', nargs='+', default=['torch', 'onnx', 'onnx-int8'],
+                        choices=['torch', 'onnx', 'onnx-int8'])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 for all cores')
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--min-match', type=float, default=0.95)
+    parser.add_argument('--min-match-int8', type=float, default=0.8)
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    images = [cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) for _, data in load_corpus(args.corpus)]
+    results, reference, failed = {'backends': {}}, None, []
+
+    for name in ['torch'] + [b for b in args.backends if b != 'torch']:
+        engine = InferenceEngine(weights=args.weights, data=args.data, imgsz=args.imgsz,
+                                 backend=name.split('-')[0], int8=name.endswith('int8'), threads=args.threads)
+        stats = {'load_time_s': engine.load_time, 'latency_ms': {}}
+        for batch_size in args.batch_sizes:
+            detections, latencies = run(engine, images, batch_size)
+            stats['latency_ms'][str(batch_size)] = percentiles(latencies)
+
+        # parity of the single image path, the one /predict takes under low load
+        detections, _ = run(engine, images, 1)
+        if reference is None:
+            reference = detections
+        else:
+            matches, conf_diffs, total = 0, [], 0
+            for ref, det in zip(reference, detections):
+                n, diffs = match(ref, det, args.iou)
+                matches, total = matches + n, total + len(ref) + len(det)
+                conf_diffs.extend(diffs)
+            stats['match_rate'] = 2 * matches / total if total else 1.0
+            stats['conf_diff_max'] = max(conf_diffs, default=0.0)
+            stats['detections'] = sum(len(d) for d in detections)
+            tolerance = args.min_match_int8 if name.endswith('int8') else args.min_match
+            if not total:
+                # e.g. untrained weights, the backends trivially agree
+                failed.append(f'{name}: no detections to compare')
+            elif stats['match_rate'] < tolerance:
+                failed.append(f'{name}: match rate {stats["match_rate"]:.3f} < {tolerance}')
+
+        results['backends'][name] = stats
+        latency = ', '.join(f'batch {b}: p50={s["p50"]:.1f} ms/img' for b, s in stats['latency_ms'].items())
+        parity = f'  match={stats["match_rate"]:.3f} conf_diff_max={stats["conf_diff_max"]:.3f}' \
+            if 'match_rate' in stats else ''
+        print(f'{name:<10} load={stats["load_time_s"]:.1f}s  {latency}{parity}')
+
+    results['config'] = {'weights': args.weights, 'imgsz': args.imgsz, 'images': len(images),
+                         'threads': args.threads, 'iou': args.iou}
+    results = save_results(results, args.output)
+
+    if args.compare:
+        compare(load_json(args.compare), results)
+    if failed:
+        sys.exit('parity check failed:\n' + '\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
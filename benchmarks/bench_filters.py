@@ -0,0 +1,95 @@
+"""
+Micro-benchmarks of the polybot Img filters across image sizes.
+
+    python benchmarks/bench_filters.py --sizes 256 512 1024 2048 --repeat 5 --output results/filters.json
+    python benchmarks/bench_filters.py --compare results/filters.json
+
+For every filter and size, reports the median and min wall time over --repeat runs,
+and the peak memory allocated by the filter (tracemalloc, which also tracks NumPy buffers).
+"""
+import argparse
+import copy
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from matplotlib.image import imsave
+
+from common import ROOT, compare, load_json, save_results
+
+sys.path.insert(0, str(ROOT / 'polybot'))
+from img_proc import Img, parse_pipeline  # noqa: E402
+
+PIPELINE = parse_pipeline('blur(8) | contour | rotate')
+
+FILTERS = {
+    'blur': lambda img, other: img.blur(),
+    'contour': lambda img, other: img.contour(),
+    'rotate': lambda img, other: img.rotate(),
+    'salt_n_pepper': lambda img, other: img.salt_n_pepper(),
+    'concat': lambda img, other: img.concat(other),
+    'segment': lambda img, other: img.segment(),
+    # the same chain, one filter after the other and as a fused pipeline
+    'chain': lambda img, other: (img.blur(8), img.contour(), img.rotate()),
+    'pipeline': lambda img, other: PIPELINE.apply(img),
+}
+
+
+def make_image(directory, size):
+    """Writes a random RGB image of size x size pixels, returns its path"""
+    path = Path(directory) / f'bench_{size}.png'
+    rng = np.random.default_rng(size)
+    imsave(path, rng.random((size, size, 3)))
+    return path
+
+
+def measure(fn, repeat, setup=lambda: ()):
+    """Times fn(*setup()), setup runs before every repetition and is not measured"""
+    times, peaks = [], []
+    for _ in range(repeat):
+        args = setup()
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+        peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+        tracemalloc.stop()
+    times.sort()
+    return {'median_ms': times[len(times) // 2], 'min_ms': times[0], 'peak_alloc_mb': max(peaks)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--filters', nargs='+', choices=list(FILTERS), default=list(FILTERS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = {'filters': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = make_image(tmp, size)
+            results['filters'].setdefault('decode', {})[str(size)] = measure(lambda: Img(path), args.repeat)
+
+            original = Img(path)
+            for name in args.filters:
+                stats = measure(FILTERS[name], args.repeat,
+                                setup=lambda: (copy.deepcopy(original), copy.deepcopy(original)))
+                results['filters'].setdefault(name, {})[str(size)] = stats
+                print(f'{name:<14} {size:>5}px  median={stats["median_ms"]:10.2f} ms  '
+                      f'min={stats["min_ms"]:10.2f} ms  peak={stats["peak_alloc_mb"]:8.1f} MB')
+
+    results['config'] = {'sizes': args.sizes, 'repeat': args.repeat}
+    results = save_results(results, args.output)
+
+    if args.compare:
+        compare(load_json(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
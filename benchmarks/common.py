@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+
+
+def load_corpus(path):
+    """Reads the images of a directory, returns a list of (file name, bytes)"""
+    files = sorted(p for p in Path(path).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not files:
+        sys.exit(f'no images found in {path}')
+    return [(p.name, p.read_bytes()) for p in files]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': values[-1],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class MemorySampler:
+    """Samples the resident memory of a process (Linux /proc) in a background thread"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss_mb(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(self.rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        samples = [s for s in self.samples if s is not None]
+        if not samples:
+            return None
+        return {'start': samples[0], 'peak': max(samples), 'mean': sum(samples) / len(samples), 'end': samples[-1]}
+
+
+def save_results(results, output):
+    results = dict(results, git_commit=git_commit(), timestamp=time.time())
+    if output:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'results saved to {output}')
+    return results
+
+
+def compare(baseline, current, path=()):
+    """Prints the relative change of every numeric value of current against the same value in baseline"""
+    for key, value in current.items():
+        if key in ('timestamp', 'git_commit', 'config') or key not in baseline:
+            continue
+        old = baseline[key]
+        if isinstance(value, dict) and isinstance(old, dict):
+            compare(old, value, path + (key,))
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and not isinstance(value, bool) and old:
+            change = (value - old) / old * 100
+            print(f'{".".join(path + (key,)):<60} {old:>12.2f} -> {value:>12.2f}  ({change:+.1f}%)')
+
+
+def load_json(path):
+    with open(os.path.expanduser(path)) as f:
+        return json.load(f)
@@ -0,0 +1,244 @@
+"""
+End-to-end load test of the yolo5 and polybot services.
+
+Start the local stand-ins (see stubs.py) and the services pointed at them, then replay a corpus of images:
+
+    # yolo5, images sent in the request body (or --mode s3 to upload them to the bucket and send their keys)
+    python benchmarks/load_test.py yolo5 --url http://localhost:8081 --corpus images/ \\
+        --concurrency 8 --requests 200 --pid <yolo5 pid> --output results/yolo5.json
+
+    # polybot, Telegram updates posted to the webhook, replies collected by the Telegram stand-in
+    python benchmarks/load_test.py polybot --url http://localhost:8443 --token <TELEGRAM_TOKEN> \\
+        --telegram http://127.0.0.1:8090 --caption blur --corpus images/ --concurrency 8 --requests 50
+
+Waits for the service to report ready on /readyz, then reports p50/p95/p99 latency, throughput, the per-stage
+timings returned by the service, its resident memory and startup time, and saves them as JSON.
+Use --compare with a previous JSON to see the changes between commits.
+
+The memory is the resident set of the --pid process as a whole, sampled during the run: it isn't attributed
+to the stages, and the filter worker processes of polybot aren't included.
+"""
+import argparse
+import itertools
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import MemorySampler, compare, load_corpus, load_json, percentiles, save_results
+from stubs import TelegramStubClient, s3_client
+
+
+def unique_bytes(data):
+    """
+    Makes the image bytes unique so every request misses the prediction cache,
+    decoders ignore the bytes appended after the end of the image
+    """
+    return data + uuid.uuid4().bytes
+
+
+class Yolo5Target:
+
+    def __init__(self, args, corpus):
+        self.url = args.url.rstrip('/')
+        self.mode = args.mode
+        self.unique = not args.allow_cache_hits
+        self.session = requests.Session()
+        self.corpus = corpus
+
+        if self.mode == 's3':
+            self.s3 = s3_client(args.s3_endpoint)
+            self.bucket = args.bucket
+
+    def prepare(self, i):
+        name, data = self.corpus[i % len(self.corpus)]
+        if self.unique:
+            data = unique_bytes(data)
+        img_name = f'bench/{i}-{name}'
+        if self.mode == 's3':
+            self.s3.put_object(Bucket=self.bucket, Key=img_name, Body=data)
+        return img_name, data
+
+    def request(self, job):
+        img_name, data = job
+        if self.mode == 's3':
+            response = self.session.post(f'{self.url}/predict', params={'imgName': img_name}, timeout=300)
+        else:
+            response = self.session.post(f'{self.url}/predict', params={'imgName': img_name}, data=data,
+                                         headers={'Content-Type': 'image/jpeg'}, timeout=300)
+
+        if response.status_code != 200:
+            return False, {}
+        return True, response.json().get('timings', {})
+
+
+class PolybotTarget:
+
+    def __init__(self, args, corpus):
+        self.webhook_url = f'{args.url.rstrip("/")}/{args.token}/'
+        self.caption = args.caption
+        self.timeout = args.timeout
+        self.session = requests.Session()
+        self.telegram = TelegramStubClient(args.telegram)
+        self.corpus = corpus
+        self.unique = not args.allow_cache_hits
+        self._ids = itertools.count(1)
+        # a fresh chat per request, so replies can be matched to requests
+        self._chat_base = int(time.time())
+
+    def prepare(self, i):
+        _, data = self.corpus[i % len(self.corpus)]
+        file_id = self.telegram.add_file(unique_bytes(data) if self.unique else data)
+        return self._chat_base * 10000 + i, file_id
+
+    def request(self, job):
+        chat_id, file_id = job
+        message_id = next(self._ids)
+        update = {
+            'update_id': message_id,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 0, 'height': 0}],
+                'caption': self.caption,
+            },
+        }
+
+        start = time.time()
+        response = self.session.post(self.webhook_url, json=update, timeout=60)
+        acked = time.time()
+        if response.status_code != 200:
+            return False, {}
+
+        # filters reply with the processed photo, predictions with a text summary
+        if 'predict' in self.caption:
+            reply = self.telegram.wait_reply(chat_id, method='sendMessage', text_prefix='Detected', timeout=self.timeout)
+        else:
+            reply = self.telegram.wait_reply(chat_id, method='sendPhoto', timeout=self.timeout)
+        if reply is None:
+            return False, {}
+
+        return True, {'webhook_ack': (acked - start) * 1000, 'reply': (reply['time'] - start) * 1000}
+
+
+def wait_ready(url, timeout):
+    """Waits for the service to report ready on /readyz (model warm, webhook registered), returns its startup status"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            response = requests.get(f'{url}/readyz', timeout=5)
+            if response.status_code == 200:
+                return response.json()
+        except requests.RequestException:
+            pass
+        if time.perf_counter() > deadline:
+            raise SystemExit(f'{url} is not ready after {timeout:.0f}s')
+        time.sleep(0.5)
+
+
+def run(target, num_requests, concurrency):
+    jobs = [target.prepare(i) for i in range(num_requests)]
+    latencies, stages, errors = [], {}, 0
+
+    def timed(job):
+        start = time.perf_counter()
+        try:
+            ok, timings = target.request(job)
+        except requests.RequestException:
+            ok, timings = False, {}
+        return ok, (time.perf_counter() - start) * 1000, timings
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for ok, latency, timings in executor.map(timed, jobs):
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(latency)
+            for stage, value in timings.items():
+                if isinstance(value, (int, float)):
+                    stages.setdefault(stage, []).append(value)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': num_requests,
+        'errors': errors,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': percentiles(latencies),
+        'stages_ms': {stage: percentiles(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('target', choices=['yolo5', 'polybot'])
+    parser.add_argument('--url', required=True, help='base URL of the service')
+    parser.add_argument('--corpus', required=True, help='directory of .jpg/.png images to replay')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2, help='requests sent before measuring')
+    parser.add_argument('--ready-timeout', type=float, default=300, help='seconds to wait for /readyz')
+    parser.add_argument('--allow-cache-hits', action='store_true',
+                        help='resend identical bytes, by default every request misses the prediction cache')
+    parser.add_argument('--pid', type=int, help='pid of the service, to sample its total resident memory')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+
+    yolo5 = parser.add_argument_group('yolo5')
+    yolo5.add_argument('--mode', choices=['bytes', 's3'], default='bytes')
+    yolo5.add_argument('--s3-endpoint', default=os.environ.get('AWS_ENDPOINT_URL', 'http://127.0.0.1:5000'))
+    yolo5.add_argument('--bucket', default=os.environ.get('BUCKET_NAME', 'bench'))
+
+    polybot = parser.add_argument_group('polybot')
+    polybot.add_argument('--token', default=os.environ.get('TELEGRAM_TOKEN'))
+    polybot.add_argument('--telegram', default='http://127.0.0.1:8090', help='URL of the Telegram stand-in')
+    polybot.add_argument('--caption', default='blur')
+    polybot.add_argument('--timeout', type=float, default=120, help='seconds to wait for the bot reply')
+
+    args = parser.parse_args()
+    corpus = load_corpus(args.corpus)
+    target = Yolo5Target(args, corpus) if args.target == 'yolo5' else PolybotTarget(args, corpus)
+    startup = wait_ready(args.url, args.ready_timeout)
+
+    if args.warmup:
+        run(target, args.warmup, 1)
+
+    if args.pid:
+        with MemorySampler(args.pid) as sampler:
+            results = run(target, args.requests, args.concurrency)
+        results['memory_mb'] = sampler.summary()
+    else:
+        results = run(target, args.requests, args.concurrency)
+    results['startup'] = startup
+
+    results['config'] = {
+        'target': args.target,
+        'url': args.url,
+        'corpus_size': len(corpus),
+        'concurrency': args.concurrency,
+        'mode': args.mode if args.target == 'yolo5' else args.caption,
+        'cache_hits_allowed': args.allow_cache_hits,
+    }
+    results = save_results(results, args.output)
+
+    latency = results['latency_ms'] or {}
+    print(f'{args.target}: {results["requests"]} requests, {results["errors"]} errors, '
+          f'{results["throughput_rps"]:.2f} req/s, latency ms p50={latency.get("p50", 0):.1f} '
+          f'p95={latency.get("p95", 0):.1f} p99={latency.get("p99", 0):.1f}')
+    for stage, stats in results['stages_ms'].items():
+        print(f'  {stage:<16} p50={stats["p50"]:.1f} p95={stats["p95"]:.1f} p99={stats["p99"]:.1f}')
+    if results.get('memory_mb'):
+        print(f'  rss MB (whole process): {results["memory_mb"]}')
+    if startup.get('startup_s') is not None:
+        print(f'  startup: ready in {startup["startup_s"]:.2f}s, phases ms: {startup["phases_ms"]}')
+
+    if args.compare:
+        compare(load_json(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
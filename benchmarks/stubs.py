@@ -0,0 +1,234 @@
+"""
+Local stand-ins for the external services, so the benchmarks run without AWS, Telegram or a MongoDB cluster:
+
+- FakeTelegram: the subset of the Telegram Bot API used by polybot, it serves the photos of the corpus and
+  records the replies the bot sends to each chat. polybot is pointed at it with TELEGRAM_API_URL.
+  The load test drives it through its /_bench/ endpoints (see TelegramStubClient).
+- start_s3(): a moto S3 server, the services are pointed at it with AWS_ENDPOINT_URL.
+- MongoDB: the yolo5 service uses an in-process mongomock database when MONGO_URI=mongomock://
+
+Run this module to start the stand-ins and print the environment to start the services with:
+
+    python benchmarks/stubs.py --telegram-port 8090 --s3-port 5000 --bucket bench
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import requests
+
+
+class FakeTelegram:
+    """
+    Minimal Telegram Bot API server: getMe, setWebhook, deleteWebhook, getWebhookInfo, getFile, file downloads,
+    sendMessage, sendPhoto
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._files = {}
+        self._replies = defaultdict(list)
+        self._cond = threading.Condition()
+        self._message_ids = itertools.count(1)
+        self._webhook_url = ''
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://{host}:{self._server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def add_file(self, data):
+        """Serves data as a Telegram file, returns its file_id"""
+        file_id = uuid.uuid4().hex
+        self._files[file_id] = data
+        return file_id
+
+    def replies(self, chat_id):
+        with self._cond:
+            return list(self._replies[chat_id])
+
+    def wait_reply(self, chat_id, predicate=lambda reply: True, timeout=120):
+        """Waits for a reply sent to chat_id that matches predicate, returns it or None on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for reply in self._replies[chat_id]:
+                    if predicate(reply):
+                        return reply
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    return None
+
+    def _handle(self, request):
+        path = urlparse(request.path)
+        params = {k: v[-1] for k, v in parse_qs(path.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+
+        parts = path.path.strip('/').split('/')
+        if parts[0] != '_bench':
+            # the async client sends the method parameters in the body
+            params.update(form_params(request.headers.get('Content-Type', ''), body))
+        if parts[0] == '_bench':
+            return self._handle_bench(request, parts[-1], params, body)
+        if parts[0] == 'file':
+            # /file/bot<token>/<file_path>, file paths are photos/<file_id>.jpg
+            file_id = parts[-1].split('.')[0]
+            data = self._files.get(file_id)
+            if data is None:
+                return self._reply(request, 404, b'not found', 'text/plain')
+            return self._reply(request, 200, data, 'image/jpeg')
+
+        method = parts[-1]
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method in ('setWebhook', 'deleteWebhook'):
+            self._webhook_url = params.get('url', '') if method == 'setWebhook' else ''
+            result = True
+        elif method == 'getWebhookInfo':
+            result = {'url': self._webhook_url, 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'getFile':
+            file_id = params.get('file_id')
+            if file_id not in self._files:
+                return self._json(request, {'ok': False, 'error_code': 400, 'description': 'file not found'}, 400)
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self._files[file_id]),
+                      'file_path': f'photos/{file_id}.jpg'}
+        elif method in ('sendMessage', 'sendPhoto'):
+            chat_id = int(params['chat_id'])
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text')}
+            with self._cond:
+                self._replies[chat_id].append({'method': method, 'text': params.get('text'), 'time': time.time()})
+                self._cond.notify_all()
+        else:
+            return self._json(request, {'ok': False, 'error_code': 404, 'description': f'{method} not supported'}, 404)
+
+        self._json(request, {'ok': True, 'result': result})
+
+    def _handle_bench(self, request, action, params, body):
+        if action == 'files':
+            return self._json(request, {'file_id': self.add_file(body)})
+        if action == 'wait':
+            # long polls the first reply to chat_id sent with method, and whose text starts with text_prefix
+            method, prefix = params.get('method'), params.get('text_prefix', '')
+            reply = self.wait_reply(
+                int(params['chat_id']),
+                lambda r: (method is None or r['method'] == method) and (r['text'] or '').startswith(prefix),
+                timeout=float(params.get('timeout', 120)),
+            )
+            return self._json(request, {'reply': reply})
+        return self._json(request, {'error': f'unknown action {action}'}, 404)
+
+    def _json(self, request, body, status=200):
+        self._reply(request, status, json.dumps(body).encode(), 'application/json')
+
+    @staticmethod
+    def _reply(request, status, body, content_type):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def form_params(content_type, body):
+    """Fields of a url encoded or multipart form body, the uploaded files are skipped"""
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=policy.HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        return {part.get_param('name', header='content-disposition'): part.get_content()
+                for part in message.iter_parts() if part.get_filename() is None}
+    return {}
+
+
+class TelegramStubClient:
+    """Client of the /_bench/ endpoints of a FakeTelegram running in another process"""
+
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def add_file(self, data):
+        return self.session.post(f'{self.url}/_bench/files', data=data).json()['file_id']
+
+    def wait_reply(self, chat_id, method=None, text_prefix='', timeout=120):
+        params = {'chat_id': chat_id, 'text_prefix': text_prefix, 'timeout': timeout}
+        if method:
+            params['method'] = method
+        return self.session.get(f'{self.url}/_bench/wait', params=params, timeout=timeout + 5).json()['reply']
+
+
+def start_s3(host='127.0.0.1', port=5000, bucket=None):
+    """Starts a moto S3 server, creates bucket in it if given, returns its endpoint URL"""
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address=host, port=port)
+    server.start()
+    endpoint = f'http://{host}:{port}'
+
+    if bucket:
+        s3_client(endpoint).create_bucket(Bucket=bucket)
+    return endpoint
+
+
+def s3_client(endpoint):
+    return boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                        aws_access_key_id='bench', aws_secret_access_key='bench')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Starts the local stand-ins of Telegram and S3')
+    parser.add_argument('--telegram-port', type=int, default=8090)
+    parser.add_argument('--s3-port', type=int, default=5000)
+    parser.add_argument('--bucket', default='bench')
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(port=args.telegram_port).start()
+    s3_endpoint = start_s3(port=args.s3_port, bucket=args.bucket)
+
+    print('Start the services with:\n')
+    print(f'export TELEGRAM_API_URL={telegram.url}')
+    print(f'export AWS_ENDPOINT_URL={s3_endpoint}')
+    print('export AWS_ACCESS_KEY_ID=bench AWS_SECRET_ACCESS_KEY=bench AWS_DEFAULT_REGION=us-east-1')
+    print(f'export BUCKET_NAME={args.bucket}')
+    print('export MONGO_URI=mongomock://')
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        telegram.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,95 @@
-import flask
-from flask import request
+import asyncio
+from aiohttp import web
 import os
-import requests
 from bot import ImageProcessingBot
+from clients import connection_stats
+from metrics import Startup, instrument_aiohttp
 
-app = flask.Flask(__name__)
+# asyncio webhook server, a single event loop serves all the chats, waiting on Telegram doesn't hold a thread
+app = web.Application()
+# the routes are measured and exposed on /metrics
+instrument_aiohttp(app)
+routes = web.RouteTableDef()
+
+# The server listens as soon as the workers are started (/healthz), the webhook is registered in the background,
+# the bot reports ready (/readyz) once Telegram sends it the messages
+startup = Startup()
 
 TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
-if os.environ.get('TELEGRAM_APP_URL'):
-    TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
-else:
-    TELEGRAM_APP_URL = requests.get('http://169.254.169.254/latest/meta-data/public-ipv4').text
+# the public URL of the EC2 instance is looked up when the webhook is registered if not given
+TELEGRAM_APP_URL = os.environ.get('TELEGRAM_APP_URL')
+
+
+@routes.get('/', name='index')
+async def index(request):
+    return web.Response(text='Ok')
+
+
+@routes.get('/healthz', name='healthz')
+async def healthz(request):
+    """Liveness: the event loop serves requests"""
+    return web.Response(text='Ok')
+
+
+@routes.get('/readyz', name='readyz')
+async def readyz(request):
+    """Readiness: the webhook is registered, with the durations of the startup phases"""
+    return web.json_response(startup.status(), status=200 if startup.ready else 503)
+
+
+@routes.post(f'/{TELEGRAM_TOKEN}/', name='webhook')
+async def webhook(request):
+    req = await request.json()
+    await bot.handle_message(req['message'])
+    return web.Response(text='Ok')
+
+
+@routes.get('/stats', name='stats')
+async def stats(request):
+    return web.json_response({
+        'startup': startup.status(),
+        'connections': connection_stats(),
+    })
+
+
+@routes.post('/results', name='results')
+async def results(request):
+    result = await request.json()
+
+    async def send_result():
+        await bot.handle_prediction_result(result)
+
+    # queued behind the chat's previous jobs, so the result is ordered after them.
+    # If the workers are full, the job message stays in the yolo5 queue and the result is pushed again later
+    if not bot.workers.submit(result['chat_id'], send_result):
+        return web.Response(status=503, text='Busy', headers={'Retry-After': '5'})
+    return web.Response(text='Ok')
+
+
+async def start_bot(app):
+    with startup.phase('session'):
+        await bot.start()
+    app['webhook'] = asyncio.ensure_future(register_webhook())
+
+
+async def register_webhook():
+    with startup.phase('webhook'):
+        await bot.register_webhook()
+    startup.set_ready()
 
 
-@app.route('/', methods=['GET'])
-def index():
-    return 'Ok'
+async def stop_bot(app):
+    app['webhook'].cancel()
+    await bot.workers.shutdown()
+    await bot.close()
 
 
-@app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
-def webhook():
-    req = request.get_json()
-    bot.handle_message(req['message'])
-    return 'Ok'
+app.add_routes(routes)
+app.on_startup.append(start_bot)
+app.on_cleanup.append(stop_bot)
 
 
 if __name__ == "__main__":
-    bot = ImageProcessingBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
-    app.run(host='0.0.0.0', port=8443)
+    with startup.phase('workers'):
+        bot = ImageProcessingBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
+    web.run_app(app, host='0.0.0.0', port=8443)
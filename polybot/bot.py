@@ -1,306 +1,374 @@
-import telebot
+import asyncio
+import aiohttp
 from loguru import logger
 import os
-import time
-from telebot.types import InputFile
-from img_proc import Img
-import requests
-import boto3
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from img_proc import parse_pipeline
+from workers import ChatWorkerPool
+from job_queue import get_queue_client
+from clients import create_aiohttp_session, get_s3_client
+from metrics import ERRORS, observe, span
+import io
 import json
-import sys
+import time
+from boto3.s3.transfer import TransferConfig
 
-class Bot:
 
-    def __init__(self, token, telegram_chat_url):
-        # create a new instance of the TeleBot class.
-        # all communication with Telegram servers are done using self.telegram_bot_client
-        self.telegram_bot_client = telebot.TeleBot(token)
+# multipart parts buffered by a streamed S3 upload: at most max_concurrency of multipart_chunksize bytes
+UPLOAD_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=2)
 
-        # remove any existing webhooks configured in Telegram servers
-        self.telegram_bot_client.remove_webhook()
-        time.sleep(0.5)
 
-        # set the webhook URL
-        self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=60)
+class AsyncChunkReader(io.RawIOBase):
+    """
+    Blocking, read-only file object over an async iterator of bytes chunks, to be read from another thread
+    than the one running loop (e.g. by boto3). Every read pulls the next chunks from the loop when needed.
+    """
 
-        logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}')
+    def __init__(self, chunks, loop):
+        self._chunks = chunks
+        self._loop = loop
+        self._buffer = bytearray()
+        self._done = False
 
-    def send_text(self, chat_id, text):
-        self.telegram_bot_client.send_message(chat_id, text)
+    def readable(self):
+        return True
 
-    def send_text_with_quote(self, chat_id, text, quoted_msg_id):
-        self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
+    def _next_chunk(self):
+        try:
+            return asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+        except StopAsyncIteration:
+            self._done = True
+            return b''
 
-    def is_current_msg_photo(self, msg):
-        return 'photo' in msg
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._buffer += self._next_chunk()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
 
-    def download_user_photo(self, msg):
-        """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
-        :return:
-        """
-        if not self.is_current_msg_photo(msg):
-            raise RuntimeError(f'Message content of type \'photo\' expected')
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
 
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+async def ec2_public_ip(session):
+    """Public IP of the EC2 instance the bot runs on, from the instance metadata"""
+    async with session.get('http://169.254.169.254/latest/meta-data/public-ipv4',
+                           timeout=aiohttp.ClientTimeout(total=5)) as response:
+        response.raise_for_status()
+        return await response.text()
 
-        with open(file_info.file_path, 'wb') as photo:
-            photo.write(data)
 
-        return file_info.file_path
+def s3_key(msg):
+    """S3 key of the photo of a message, every photo has its own so a chat's next photo doesn't replace it"""
+    return f'{msg["chat"]["id"]}/{msg["message_id"]}.jpeg'
 
-    def send_photo(self, chat_id, img_path):
-        if not os.path.exists(img_path):
-            raise RuntimeError("Image path doesn't exist")
 
-        self.telegram_bot_client.send_photo(
-            chat_id,
-            InputFile(img_path)
-        )
+def trace_id(msg):
+    """Identifies the processing of a message in the logs and timing spans, and in the YOLO5 microservice"""
+    return f'{msg["chat"]["id"]}-{msg["message_id"]}'
+
+
+class Bot:
+    """
+    Asynchronous Telegram bot, its methods run on the event loop of the webhook server.
+    start() must be awaited inside the running loop before the first message is handled,
+    and register_webhook() for Telegram to send the messages to telegram_chat_url.
+    """
+
+    def __init__(self, token, telegram_chat_url=None):
+        # talk to another Telegram Bot API server, e.g. the local stand-in used by the benchmarks
+        telegram_api_url = os.environ.get('TELEGRAM_API_URL')
+        if telegram_api_url:
+            asyncio_helper.API_URL = telegram_api_url + '/bot{0}/{1}'
+            asyncio_helper.FILE_URL = telegram_api_url + '/file/bot{0}/{1}'
+
+        self.token = token
+        # public URL of the bot, the one of the EC2 instance if not given
+        self.telegram_chat_url = telegram_chat_url
+        # create a new instance of the AsyncTeleBot class.
+        # all communication with Telegram servers are done using self.telegram_bot_client
+        self.telegram_bot_client = AsyncTeleBot(token)
+        self.session = None
+
+    async def start(self):
+        # send the Telegram API calls and the other HTTP calls of the bot through a single, pooled session
+        self.session = create_aiohttp_session()
+        asyncio_helper.session_manager.session = self.session
+
+    async def register_webhook(self, max_delay=60):
+        """
+        Points the Telegram webhook to this bot. The webhook is only set if it points elsewhere, set_webhook()
+        replaces the previous one, so it doesn't have to be removed first. Failures are retried with backoff,
+        e.g. when replicas started together hit the Telegram rate limit.
+        """
+        delay = 1
+        while True:
+            try:
+                if self.telegram_chat_url is None:
+                    self.telegram_chat_url = await ec2_public_ip(self.session)
+                url = f'{self.telegram_chat_url}/{self.token}/'
+                if (await self.telegram_bot_client.get_webhook_info()).url != url:
+                    await self.telegram_bot_client.set_webhook(url=url, timeout=60)
+                    logger.info(f'webhook set to {self.telegram_chat_url}')
+                return
+            except (asyncio_helper.ApiException, asyncio_helper.RequestTimeout, aiohttp.ClientError,
+                    asyncio.TimeoutError) as e:
+                logger.warning(f'webhook registration failed, retrying in {delay}s: {e}')
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, max_delay)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def send_text(self, chat_id, text):
+        await self.telegram_bot_client.send_message(chat_id, text)
+
+    async def send_text_with_quote(self, chat_id, text, quoted_msg_id):
+        await self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
+
+    def is_current_msg_photo(self, msg):
+        return 'photo' in msg
 
-    def handle_message(self, msg):
+    async def stream_user_photo(self, msg, chunk_size=64 * 1024):
+        """
+        Streams the photo sent to the Bot straight from Telegram, chunk by chunk, without writing it to disk.
+        Chunks are pulled from the connection as the consumer asks for them, so at most one is buffered here.
+        """
+        if not self.is_current_msg_photo(msg):
+            raise RuntimeError(f'Message content of type \'photo\' expected')
+
+        # only the time spent on Telegram is measured, not the time the consumer takes between two chunks
+        elapsed, start = 0, time.perf_counter()
+        try:
+            file_info = await self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
+            file_url = (asyncio_helper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(
+                self.token, file_info.file_path)
+            async with self.session.get(file_url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    elapsed, start = elapsed + time.perf_counter() - start, None
+                    yield chunk
+                    start = time.perf_counter()
+        except Exception:
+            ERRORS.labels('telegram_download').inc()
+            raise
+        finally:
+            if start is not None:
+                elapsed += time.perf_counter() - start
+            observe('telegram_download', elapsed, trace_id(msg))
+
+    async def read_user_photo(self, msg):
+        """The bytes of the photo sent to the Bot, read in memory without a disk file"""
+        return b''.join([chunk async for chunk in self.stream_user_photo(msg)])
+
+    async def send_photo_bytes(self, chat_id, data):
+        await self.telegram_bot_client.send_photo(chat_id, data)
+
+    async def handle_message(self, msg):
         """Bot Main message handler"""
         logger.info(f'Incoming message: {msg}')
         if 'text' in msg:
-            self.send_text(msg['chat']['id'], f'Your original message: {msg["text"]}')
+            await self.send_text(msg['chat']['id'], f'Your original message: {msg["text"]}')
 
 class QuoteBot(Bot):
-    def handle_message(self, msg):
+    async def handle_message(self, msg):
         logger.info(f'Incoming message: {msg}')
         if msg["text"] != 'Please don\'t quote me':
-                    self.send_text_with_quote(msg['chat']['id'], msg["text"], quoted_msg_id=msg["message_id"])
+                    await self.send_text_with_quote(msg['chat']['id'], msg["text"], quoted_msg_id=msg["message_id"])
 
 class ImageProcessingBot(Bot):
-    def __init__(self, token, telegram_chat_url):
-        super().__init__(token, telegram_chat_url)
-        self.processing_completed = True
-
-    def handle_message(self, msg):
-        if not self.processing_completed:
-            logger.info("Previous message processing is not completed. Ignoring current message.")
-            return
+    # Img filters that can be requested in the caption, the first one found in the caption is applied,
+    # unless the caption is a pipeline of filters (see img_proc.parse_pipeline).
+    # Img.segment is not one of them, it splits the image into several ones that can't be sent back as a photo.
+    # Img.concat neither, a message holds a single photo (the sizes of msg['photo'] are the same one)
+    FILTERS = ('blur', 'contour', 'rotate', 'salt_n_pepper')
 
+    def __init__(self, token, telegram_chat_url, workers=None):
+        super().__init__(token, telegram_chat_url)
+        # the webhook only queues the work, so Telegram is acknowledged immediately and no message is dropped
+        self.workers = workers or ChatWorkerPool(
+            max_workers=int(os.environ.get('FILTER_WORKERS', 0)) or None,
+            max_pending=int(os.environ.get('MAX_PENDING_JOBS', 100)),
+        )
+        # prediction jobs are sent to the YOLO5 microservice through a queue
+        self.jobs_queue_url = os.environ.get('JOBS_QUEUE_URL')
+        self.jobs_queue = get_queue_client() if self.jobs_queue_url else None
+        # when the bot runs next to the YOLO5 microservice, photos are sent to it directly instead
+        self.yolo5_direct_url = os.environ.get('YOLO5_DIRECT_URL')
+        # how long a direct prediction is waited for, the microservice rejects it right away if it can't make it,
+        # and the user is told the photo is queued if it takes longer than yolo5_notice_after seconds
+        self.yolo5_timeout = float(os.environ.get('YOLO5_TIMEOUT', 60))
+        self.yolo5_notice_after = float(os.environ.get('YOLO5_NOTICE_AFTER', 5))
+        if self.jobs_queue is None and not self.yolo5_direct_url:
+            logger.warning('neither JOBS_QUEUE_URL nor YOLO5_DIRECT_URL is set, only the filters are available')
+
+    async def handle_message(self, msg):
         if "photo" in msg:
             # If the message contains a photo, check if it also has a caption
             if "caption" in msg:
                 caption = msg["caption"].lower()
+                # A filter pipeline, e.g. 'blur(8) | contour | rotate'
+                if '|' in caption or '(' in caption:
+                    try:
+                        pipeline = parse_pipeline(caption)
+                    except ValueError as e:
+                        await self.send_text(msg['chat']['id'], f"Invalid filter pipeline: {e}.\n"
+                                                                f"Example: blur(8) | contour | rotate")
+                        return
+                    await self.submit_job(msg, lambda: self.process_image(msg, pipeline))
+                    return
+
                 # Check for different processing methods in the caption
-                if 'blur' in caption:
-                    self.process_image_blur(msg)
-                elif 'contour' in caption:
-                    self.process_image_contour(msg)
-                elif 'rotate' in caption:
-                    self.process_image_rotate(msg)
-                elif 'segment' in caption:
-                    self.process_image_segment(msg)
-                elif 'salt_n_pepper' in caption:
-                    self.process_image_salt_and_pepper(msg)
-                elif 'concat' in caption:
-                    self.process_image_concat(msg)
-                elif "predict" in caption.lower():
-                    self.upload_2_S3(msg)
+                filter_name = next((f for f in self.FILTERS if f in caption), None)
+                if filter_name is not None:
+                    await self.submit_job(msg, lambda: self.process_image(msg, filter_name))
+                elif "predict" in caption:
+                    await self.submit_job(msg, lambda: self.predict(msg))
+                elif "concat" in caption:
+                    await self.send_text(msg['chat']['id'], "Please send at least two photos to concatenate.")
+                elif "segment" in caption:
+                    await self.send_text(msg['chat']['id'], f"The segment filter is not supported. "
+                                                            f"Please use one of: {', '.join(self.FILTERS)}.")
                 else:
-                    self.send_text(msg['chat']['id'],"Unknown processing method. Please provide a valid method in the caption.")
-
+                    await self.send_text(msg['chat']['id'],"Unknown processing method. Please provide a valid method in the caption.")
 
             else:
                 logger.info("Received photo without a caption.")
         elif "text" in msg:
-            super().handle_message(msg)  # Call the parent class method to handle text messages
-
-    def process_image(self, msg):
-        self.processing_completed = False
-
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-        another_image_path = self.download_user_photo(msg)
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-        another_image = Img(another_image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.concat(another_image)  # Concatenate the two images
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_contour(self, msg):
-        self.processing_completed = False
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.contour()  # contur the image
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-        #Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_rotate(self, msg):
-        self.processing_completed = False
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.rotate()  # rotate the image
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_blur(self, msg):
-        self.processing_completed = False
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.blur()  # blur the image
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_segment(self, msg):
-        self.processing_completed = False
-        # Download the photo sent by the user
-        image_path = self.download_user_photo(msg)
-        # Create an Img object from the downloaded image
-        image = Img(image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.segment()  # Segment the image
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_salt_and_pepper(self, msg):
-        self.processing_completed = False
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-        # Process the image using your custom methods (e.g., apply filter)
-        image.salt_and_pepper()  # salt_and_pepper the image
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def process_image_concat(self, msg):
-        self.processing_completed = False
-
-        # Check if the message contains at least two photos
-        if "photo" not in msg or len(msg["photo"]) < 2:
-            self.send_text(msg['chat']['id'], "Please send at least two photos to concatenate.")
-        self.processing_completed = True
-        return
-
-        # Download the two photos sent by the user
-        image_path1 = self.download_user_photo(msg)
-        image_path2 = self.download_user_photo(msg)
-
-        # Create two different Img objects from the downloaded images
-        image1 = Img(image_path1)
-        image2 = Img(image_path2)
-
-        # Concatenate the two images
-        image1.concat(image2)
-
-        # Save the processed image to the specified folder
-        processed_image_path = image1.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_photo(msg['chat']['id'], processed_image_path)
-        self.processing_completed = True
-
-    def predict_message(self, msg):
-        logger.info(f'Incoming message: {msg}')
-
-        if self.is_current_msg_photo(msg):
-            photo_path = self.download_user_photo(msg)
-
-            # TODO upload the photo to S3
-            s3_bucket_name = 'gershonm-s3'
-            s3_photo_key = f'photos/{photo_path}'
-            self.s3.upload_file(photo_path, s3_bucket_name, s3_photo_key)
-            logger.info(f'Uploaded user\'s photo to S3: {s3_photo_key}')
-
-            # TODO send a request to the `yolo5` service for prediction
-            yolo5_service_url = 'http://localhost:8081/predict'  # Replace with actual URL
-            response = requests.post(yolo5_service_url, params={'imgName': s3_photo_key})
-
-            # TODO send results to the Telegram end-user
-            prediction_results = response.json()
-
-            # Send the results back to the Telegram end-user
-            self.send_text(msg['chat']['id'], f'Object detection results: {prediction_results}')
-
-    def upload_2_S3(self, msg):
-        self.processing_completed = False
-        image_path = self.download_user_photo(msg)
-        # Upload the image to S3
-        s3_client = boto3.client('s3')
+            await super().handle_message(msg)  # Call the parent class method to handle text messages
+
+    async def submit_job(self, msg, job):
+        async def traced_job():
+            with span('job', trace_id(msg)):
+                await job()
+
+        if not self.workers.submit(msg['chat']['id'], traced_job):
+            logger.warning(f'chat {msg["chat"]["id"]}: too many pending jobs, message rejected')
+            await self.send_text(msg['chat']['id'], "The bot is busy right now, please try again in a few moments.")
+
+    async def process_image(self, msg, filters):
+        # Download the photo sent by the user in memory
+        data = await self.read_user_photo(msg)
+        # Apply the filter in a worker process, the processed image comes back encoded, nothing touches the disk
+        with span('filter', trace_id(msg)):
+            try:
+                processed_image = await self.workers.run_filter_bytes(data, filters)
+            except ValueError as e:
+                # e.g. a pipeline that crops the image away
+                await self.send_text(msg['chat']['id'], f"The filters could not be applied: {e}")
+                return
+
+        # Send the processed image back to the user
+        with span('telegram_send', trace_id(msg)):
+            await self.send_photo_bytes(msg['chat']['id'], processed_image)
+
+    async def predict(self, msg):
+        if self.yolo5_direct_url:
+            await self.predict_direct(msg)
+        elif self.jobs_queue is not None:
+            await self.upload_2_S3(msg)
+        else:
+            await self.send_text(msg['chat']['id'], "Object detection is not available right now.")
+
+    def is_tiled(self, msg):
+        """'predict tiled' predicts large photos tile by tile, to find the small objects"""
+        return 'tiled' in msg.get('caption', '').lower()
+
+    async def notify_queued(self, chat_id, delay):
+        """Tells the user the photo is queued if the prediction is still running after delay seconds"""
+        await asyncio.sleep(delay)
+        await self.send_text(chat_id, "The object detection service is busy, your image is queued. "
+                                      "The results will be sent shortly.")
+
+    async def predict_direct(self, msg):
+        chat_id = msg['chat']['id']
+
+        # Pipe the photo from Telegram into the request body (chunked), the YOLO5 microservice stores it in S3
+        # in the background. The prediction is traced under the same id in the YOLO5 microservice
+        notice = asyncio.ensure_future(self.notify_queued(chat_id, self.yolo5_notice_after))
+        try:
+            with span('yolo5_request', trace_id(msg)):
+                async with self.session.post(
+                    f'{self.yolo5_direct_url}/predict',
+                    # only the per-class summary of the detections is sent back, not every box
+                    params={'imgName': s3_key(msg), 'chatId': chat_id, 'predictionId': trace_id(msg),
+                            'tiled': str(self.is_tiled(msg)).lower(), 'boxes': 'false'},
+                    data=self.stream_user_photo(msg),
+                    headers={'Content-Type': 'image/jpeg', 'X-Request-Timeout': str(self.yolo5_timeout)},
+                    timeout=aiohttp.ClientTimeout(total=self.yolo5_timeout),
+                ) as response:
+                    status, retry_after = response.status, response.headers.get('Retry-After', '5')
+                    if status == 200:
+                        result = {'chat_id': chat_id, 'prediction': await response.json()}
+                    else:
+                        result = {'chat_id': chat_id, 'error': await response.text()}
+        except asyncio.TimeoutError:
+            status, result = None, {'chat_id': chat_id, 'error': f'no response in {self.yolo5_timeout:.0f}s'}
+        except aiohttp.ClientError as e:
+            # down, restarting or the connection dropped: unavailable like when it sheds the load
+            logger.warning(f'chat {chat_id}: object detection service unreachable: {e}')
+            status, retry_after = 503, '5'
+        finally:
+            notice.cancel()
+
+        # Rejected by the admission control of the YOLO5 microservice, instead of waiting longer than the timeout
+        if status == 429:
+            await self.send_text(chat_id, f"You are sending photos faster than they can be processed, "
+                                          f"please try again in {retry_after} seconds.")
+        elif status == 503 and self.jobs_queue is not None:
+            # its queue workers will predict the photo at their pace, and push the results back
+            await self.upload_2_S3(msg, notice="The object detection service is busy, your image is queued. "
+                                               "The results will be sent shortly.")
+        elif status == 503:
+            await self.send_text(chat_id, f"The object detection service is busy, "
+                                          f"please try again in {retry_after} seconds.")
+        else:
+            await self.handle_prediction_result(result)
+
+    async def upload_2_S3(self, msg, notice="Your image is being processed, the results will be sent shortly."):
+        # Pipe the photo from Telegram into the S3 upload (multipart for large photos), boto3 is blocking so it
+        # runs in a thread that pulls the chunks from the event loop
+        s3_client = get_s3_client()
         images_bucket = 'gershonm-s3'
-        s3_key = f'{msg["chat"]["id"]}.jpeg'
-        s3_client.upload_file(image_path, images_bucket, s3_key)
-
-        time.sleep(5)
-
-        # Send a request to the YOLO5 microservice # with the containers name once its build
-        yolo5_url = f'http://my_yolo5:8081/predict?imgName={s3_key}'
-        response = requests.post(yolo5_url)
-        if response.status_code == 200:
-            # Print the JSON response as text
-            json_response = response.text
-            print(json_response)
-            sys.stdout.flush()
-
-            # Parse the Json file and send user a message:
-            response_data = json.loads(json_response)
-            # Initialize a dictionary to store the class counts
-            class_counts = {}
-
-            # Iterate through the labels and count the occurrences of each class
-            for label in response_data['labels']:
-                class_name = label['class']
-                if class_name in class_counts:
-                    class_counts[class_name] += 1
-                else:
-                    class_counts[class_name] = 1
+        photo = AsyncChunkReader(self.stream_user_photo(msg), asyncio.get_running_loop())
+        with span('s3_upload', trace_id(msg)):
+            await self.workers.run_blocking(s3_client.upload_fileobj, photo, images_bucket, s3_key(msg),
+                                            Config=UPLOAD_CONFIG)
+
+        # Queue a prediction job for the YOLO5 microservice,
+        # one of its workers will pick it up and push the result back to the /results endpoint
+        job = {'imgName': s3_key(msg), 'chat_id': msg['chat']['id'], 'prediction_id': trace_id(msg),
+               'tiled': self.is_tiled(msg)}
+        with span('enqueue', trace_id(msg)):
+            await self.workers.run_blocking(self.jobs_queue.send_message, QueueUrl=self.jobs_queue_url,
+                                            MessageBody=json.dumps(job))
+        logger.info(f'chat {msg["chat"]["id"]}: prediction job queued for {s3_key(msg)}')
+
+        await self.send_text(msg['chat']['id'], notice)
+
+    async def handle_prediction_result(self, result):
+        """Sends the result of a prediction job, pushed by the YOLO5 microservice, to the user"""
+        chat_id = result['chat_id']
+        if 'error' in result:
+            logger.error(f'chat {chat_id}: prediction failed: {result["error"]}')
+            await self.send_text(chat_id, "Sorry, the objects in your image could not be detected.")
+            return
 
-            # Create a message with the detected objects and their counts
-            message = "Detected Objects:\n"
-            for class_name, count in class_counts.items():
-                message += f"{class_name}: {count}\n"
+        # The YOLO5 microservice already counted the objects of each class, the most frequent first
+        summary = result['prediction']['summary']
 
-            # Send the message to the user
-            self.telegram_bot_client.send_message(msg['chat']['id'], message)
+        # Create a message with the detected objects and their counts
+        message = "Detected Objects:\n"
+        for class_name, stats in summary.items():
+            message += f"{class_name}: {stats['count']}\n"
 
-        self.processing_completed = True
\ No newline at end of file
+        # Send the message to the user
+        with span('telegram_send', result['prediction'].get('prediction_id')):
+            await self.telegram_bot_client.send_message(chat_id, message)
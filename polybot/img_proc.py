@@ -1,22 +1,117 @@
+import ast
+import io
+import math
+import os
+import re
+import tempfile
 from pathlib import Path
-from matplotlib.image import imread, imsave
-import random
+from matplotlib import cm
+from matplotlib.image import imsave
+import numpy as np
+from PIL import Image
 
+# arrays larger than this are memory-mapped on a temporary file rather than allocated in the process memory
+MEMMAP_MIN_BYTES = int(os.environ.get('IMG_MEMMAP_MB', 64)) * 2 ** 20
+# largest image a Pipeline may produce at any step, every concat doubles the width
+MAX_PIXELS = int(os.environ.get('IMG_MAX_PIXELS', 4 * 2560 ** 2))
 
-def rgb2gray(rgb):
-    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
-    gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
-    return gray
+
+def scratch(shape, dtype=np.uint8):
+    """
+    Uninitialized array for a filter result.
+    Very large ones are backed by an (already deleted) temporary file, so the kernel can write their pages out
+    instead of the worker process growing by the size of a few images.
+    """
+    if math.prod(shape) * np.dtype(dtype).itemsize < MEMMAP_MIN_BYTES:
+        return np.empty(shape, dtype)
+    with tempfile.TemporaryFile() as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+
+def decode(src, max_side=None):
+    """
+    Decodes an image (path or binary file object) to a 2D uint8 array of gray levels (ITU-R 601-2 luma).
+    JPEGs are decoded by libjpeg straight to grayscale, without an RGB copy, and when max_side is given,
+    at the smallest 1/2, 1/4 or 1/8 scale that still keeps the longest side at least max_side.
+    """
+    with Image.open(src) as im:
+        if im.format == 'JPEG':
+            width, height = im.size
+            scale = min(1, max_side / max(width, height)) if max_side else 1
+            im.draft('L', (math.ceil(width * scale), math.ceil(height * scale)))
+        return np.array(im if im.mode == 'L' else im.convert('L'))
+
+
+def to_gray_image(data):
+    """
+    The image imsave(data, cmap='gray') writes, as a single channel PIL image:
+    the levels are stretched from [min, max] to [0, 255] by the gray colormap.
+    The colormap is only evaluated on the 256 possible uint8 levels, then looked up,
+    instead of converting the whole image to float RGBA.
+    """
+    mappable = cm.ScalarMappable(cmap='gray')
+    mappable.set_clim(data.min(), data.max())
+    lut = mappable.to_rgba(np.arange(256, dtype=np.uint8), bytes=True)[:, 0]
+    return Image.fromarray(lut[data])
+
+
+def blur(data, blur_level=16, out=None):
+    """
+    Box filter with running sums: the sum of the blur_level rows of the window is kept for every column, and
+    updated by adding the row entering the window and subtracting the row leaving it, every output row is
+    then a difference of the cumulative sums of these column sums.
+    Besides the result, only a few rows are allocated, and uint8 levels are summed exactly, as integers.
+    :param out: array of the shape and dtype of the result to write it to, allocated if not given
+    """
+    height, width = data.shape
+    filter_sum = blur_level ** 2
+    out = scratch((height - blur_level + 1, width - blur_level + 1), data.dtype) if out is None else out
+
+    dtype = np.int64 if np.issubdtype(data.dtype, np.integer) else np.float64
+    column_sums = data[:blur_level].sum(axis=0, dtype=dtype)
+    cumsum = np.zeros(width + 1, dtype)
+    window_sums = np.empty(out.shape[1], dtype)
+    for row in range(out.shape[0]):
+        if row:
+            column_sums += data[row + blur_level - 1]
+            column_sums -= data[row - 1]
+        np.cumsum(column_sums, out=cumsum[1:])
+        np.subtract(cumsum[blur_level:], cumsum[:-blur_level], out=window_sums)
+        np.floor_divide(window_sums, filter_sum, out=out[row], casting='unsafe')
+    return out
+
+
+def contour(data, out=None):
+    """Absolute horizontal gradient, one column narrower than data"""
+    out = scratch((data.shape[0], data.shape[1] - 1), data.dtype) if out is None else out
+    # max - min rather than abs(a - b), which would wrap around for unsigned levels
+    np.maximum(data[:, 1:], data[:, :-1], out=out)
+    out -= np.minimum(data[:, 1:], data[:, :-1])
+    return out
+
+
+def salt_n_pepper(data, amount=0.05, rows=256):
+    """Sets random pixels of data to 0 or 255 in place, a band of rows at a time to keep the random draws small"""
+    for start in range(0, data.shape[0], rows):
+        band = data[start:start + rows]
+        salt = np.random.random(band.shape) < amount
+        pepper = ~salt & (np.random.random(band.shape) < amount)
+        band[salt] = 0
+        band[pepper] = 255
 
 
 class Img:
 
-    def __init__(self, path):
+    def __init__(self, path, fileobj=None, max_side=None):
         """
-        Do not change the constructor implementation
+        The image is kept as a 2D uint8 NumPy array of gray levels, all the filters below are vectorized on it
+        :param fileobj: binary file object to decode the image from instead of the file at path,
+            path then only names the image and gives its format
+        :param max_side: the image will be downscaled to this size anyway, JPEGs larger than that are decoded
+            at a reduced resolution (see decode())
         """
         self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        self.data = decode(path if fileobj is None else fileobj, max_side)
 
     def save_img(self):
         """
@@ -26,78 +121,186 @@ class Img:
         imsave(new_path, self.data, cmap='gray')
         return new_path
 
-    def blur(self, blur_level=16):
-
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
-
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+    def encode(self, format=None):
+        """
+        The image encoded like save_img() saves it (in the format of its path by default), but in memory.
+        The pixels are the same, in a single channel image instead of RGB(A) with equal channels.
+        """
+        format = format or self.path.suffix[1:] or 'png'
+        buf = io.BytesIO()
+        if self.data.dtype != np.uint8:
+            imsave(buf, self.data, cmap='gray', format=format)
+        else:
+            to_gray_image(self.data).save(buf, format=Image.registered_extensions().get(f'.{format.lower()}', format))
+        return buf.getvalue()
 
-        self.data = result
+    def blur(self, blur_level=16):
+        self.data = blur(self.data, blur_level)
 
     def contour(self):
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j - 1] - row[j]))
-
-            self.data[i] = res
+        self.data = contour(self.data)
 
     def rotate(self):
-        height = len(self.data)
-        width = len(self.data[0])
-
-        # Create a new empty list for rotated data
-        rotated_data = [[0 for i in range(height)] for i in range(width)]
-
-        for x in range(width):
-            for y in range(height):
-                rotated_data[x][y] = self.data[height - y - 1][x]
-
-        # Update the data with the rotated data
-        self.data = rotated_data
+        # clockwise, rotated[x][y] = data[height - y - 1][x]
+        self.data = np.rot90(self.data, k=-1)
 
     def salt_n_pepper(self, amount=0.05):
-        height = len(self.data)
-        width = len(self.data[0])
-
-        for x in range(width):
-            for y in range(height):
-                if random.random() < amount:
-                    self.data[y][x] = 0
-                elif random.random() < amount:
-                    self.data[y][x] = 255
+        self.data = self.data.copy()
+        salt_n_pepper(self.data, amount)
 
     def concat(self, other_img, direction='horizontal'):
         other_data = other_img.data
-        height = min(len(self.data), len(other_data))
-        width = min(len(self.data[0]), len(other_data[0]))
+        height = min(self.data.shape[0], other_data.shape[0])
+        width = min(self.data.shape[1], other_data.shape[1])
 
+        parts = [self.data[:height, :width], other_data[:height, :width]]
         if direction == 'horizontal':
-            concatenated_data = [self.data[i][:width] + other_data[i][:width] for i in range(height)]
+            self.data = np.concatenate(parts, axis=1, out=scratch((height, 2 * width), self.data.dtype))
         else:  # direction == 'vertical'
-            concatenated_data = self.data[:height] + other_data[:height]
-
-        self.data = concatenated_data
+            self.data = np.concatenate(parts, axis=0, out=scratch((2 * height, width), self.data.dtype))
 
     def segment(self, num_segments=4):
-        height = len(self.data)
-        len(self.data[0])
+        height = self.data.shape[0]
         segment_height = height // num_segments
 
         segments = []
         for i in range(num_segments):
             start_row = i * segment_height
             end_row = start_row + segment_height if i != num_segments - 1 else height
-            segment = self.data[start_row:end_row]
-            segments.append(segment)
+            segments.append(self.data[start_row:end_row])
 
         self.data = segments
+
+
+class Pipeline:
+    """
+    Chain of Img filters, e.g. parse_pipeline('blur(8) | contour | rotate').
+    It is composed lazily, nothing runs until apply(), which then runs the whole chain in a single pass:
+    - consecutive rotations are fused into one, and rotations are strided views, they never copy the image
+    - the other filters write their result into scratch buffers sized once for the largest step, and reused from
+      step to step instead of allocating a full image per step.
+      A chain needs 2 of them whatever its length, salt_n_pepper works in place
+    """
+    FILTERS = ('blur', 'contour', 'rotate', 'salt_n_pepper', 'concat')
+    MAX_STEPS = 10
+
+    def __init__(self, steps=()):
+        self.steps = list(steps)
+
+    def then(self, name, *args):
+        """A new pipeline, with the filter name (called with args) appended to this one"""
+        if name not in self.FILTERS:
+            raise ValueError(f'unknown filter {name}, expected one of {", ".join(self.FILTERS)}')
+        if len(self.steps) >= self.MAX_STEPS:
+            raise ValueError(f'at most {self.MAX_STEPS} filters can be chained')
+        return Pipeline(self.steps + [(name, args)])
+
+    def __str__(self):
+        return ' | '.join(f'{name}({", ".join(map(str, args))})' if args else name for name, args in self.steps)
+
+    def fused(self):
+        """The steps, with consecutive rotations merged into a single ('rotate', (quarter turns,)) step"""
+        steps = []
+        for name, args in self.steps:
+            if name == 'rotate':
+                turns = args[0] if args else 1
+                if steps and steps[-1][0] == 'rotate':
+                    turns += steps.pop()[1][0]
+                steps.append(('rotate', (turns % 4,)))
+            else:
+                steps.append((name, args))
+        return [(name, args) for name, args in steps if (name, args) != ('rotate', (0,))]
+
+    def apply(self, img):
+        steps = self.fused()
+        shapes = [img.data.shape]
+        for name, args in steps:
+            shapes.append(output_shape(name, args, shapes[-1]))
+        if min(min(shape) for shape in shapes) < 1:
+            raise ValueError(f'the image is too small for {self}')
+        # every scratch buffer can hold the largest image of the chain
+        size = max(height * width for height, width in shapes)
+        if size > MAX_PIXELS:
+            raise ValueError(f'the image is too large for {self}')
+        buffers = []
+        data, owner = img.data, None  # owner: index of the buffer holding data, None while it is the original
+
+        def free_buffer(*busy):
+            for index in range(len(buffers)):
+                if index not in busy:
+                    return index
+            buffers.append(scratch((size,), img.data.dtype))
+            return len(buffers) - 1
+
+        def view(index, shape):
+            return buffers[index][:shape[0] * shape[1]].reshape(shape)
+
+        for (name, args), shape in zip(steps, shapes[1:]):
+            if name == 'rotate':
+                data = np.rot90(data, k=-args[0])
+            elif name == 'blur':
+                out = free_buffer(owner)
+                data, owner = blur(data, *args, out=view(out, shape)), out
+            elif name == 'contour':
+                out = free_buffer(owner)
+                data, owner = contour(data, out=view(out, shape)), out
+            elif name == 'salt_n_pepper':
+                if owner is None:
+                    # never modify the original image in place
+                    owner = free_buffer()
+                    np.copyto(view(owner, shape), data)
+                    data = view(owner, shape)
+                salt_n_pepper(data, *args)
+            elif name == 'concat':
+                out = free_buffer(owner)
+                width = data.shape[1]
+                concatenated = view(out, shape)
+                concatenated[:, :width] = data
+                concatenated[:, width:] = data
+                data, owner = concatenated, out
+
+        # the result may be a view of a scratch buffer, it becomes the image data and keeps the buffer alive
+        img.data = data
+        return img
+
+
+def output_shape(name, args, shape):
+    height, width = shape
+    if name == 'blur':
+        level = args[0] if args else 16
+        return height - level + 1, width - level + 1
+    if name == 'contour':
+        return height, width - 1
+    if name == 'rotate':
+        return (width, height) if args[0] % 2 else (height, width)
+    if name == 'concat':
+        return height, 2 * width
+    return shape
+
+
+STEP = re.compile(r'^\s*([a-z_]+)\s*(?:\((.*)\))?\s*$')
+
+
+def parse_pipeline(spec):
+    """
+    Parses a filter pipeline spec like 'blur(8) | contour | rotate', arguments are Python literals.
+    :raise ValueError: if spec is not a valid pipeline
+    """
+    pipeline = Pipeline()
+    for step in spec.lower().split('|'):
+        match = STEP.match(step)
+        if match is None:
+            raise ValueError(f'invalid filter "{step.strip()}"')
+        name, args = match.group(1), match.group(2)
+        try:
+            args = ast.literal_eval(f'({args},)') if args and args.strip() else ()
+        except (SyntaxError, ValueError):
+            raise ValueError(f'invalid arguments for {name}: {match.group(2)}')
+        if not all(isinstance(arg, (int, float)) and not isinstance(arg, bool) for arg in args) or len(args) > 1:
+            raise ValueError(f'{name} takes at most one number argument')
+        if name in ('blur', 'rotate') and args and (not isinstance(args[0], int) or args[0] < 1):
+            raise ValueError(f'{name} takes a positive whole number')
+        if name in ('contour', 'concat') and args:
+            raise ValueError(f'{name} takes no argument')
+        pipeline = pipeline.then(name, *args)
+    return pipeline
@@ -0,0 +1,231 @@
+# Shared by the polybot and yolo5 services, the two copies of this module are kept identical on purpose:
+# instrument() is yolo5's (Flask), instrument_aiohttp() is polybot's.
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+from loguru import logger
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram('stage_duration_seconds', 'Duration of the processing stages', ['stage'], buckets=BUCKETS)
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Duration of the HTTP requests', ['endpoint'],
+                            buckets=BUCKETS)
+IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being processed', ['endpoint'])
+ERRORS = Counter('errors_total', 'Failed HTTP requests and processing stages', ['where'])
+STARTUP_SECONDS = Gauge('startup_phase_seconds', 'Duration of the startup phases', ['phase'])
+READY = Gauge('ready', 'Whether the startup completed and the service is ready to serve requests')
+
+
+@contextmanager
+def span(stage, trace_id=None):
+    """
+    Times a processing stage: observes its duration in the stage histogram, counts it as an error if it raises,
+    and logs it with the trace id (the prediction id, or the chat id for bot jobs) as structured fields
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(stage).inc()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, trace_id)
+
+
+def observe(stage, seconds, trace_id=None):
+    """Records a stage duration that was measured elsewhere (e.g. the timings returned by the inference engine)"""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    logger.bind(trace_id=trace_id, stage=stage, duration_ms=round(seconds * 1000, 2)).debug(
+        f'{trace_id}: {stage} took {seconds * 1000:.1f} ms')
+
+
+class Startup:
+    """
+    Startup phases of a service (e.g. loading and warming up the model), run while it already listens.
+    Every phase is timed, logged and exported, the service is ready once set_ready() is called,
+    and it failed if a phase raised. The readiness probe reports status().
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.error = None
+        self.total = None
+        self._ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error = f'{name}: {e}'
+            logger.exception(f'startup: {name} failed')
+            raise
+        seconds = time.perf_counter() - start
+        self.phases[name] = round(seconds * 1000, 1)
+        STARTUP_SECONDS.labels(name).set(seconds)
+        logger.info(f'startup: {name} took {seconds * 1000:.0f} ms')
+
+    def set_ready(self):
+        self.total = time.perf_counter() - self.start
+        STARTUP_SECONDS.labels('total').set(self.total)
+        READY.set(1)
+        self._ready.set()
+        logger.info(f'startup: ready in {self.total:.2f}s, phases (ms): {self.phases}')
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def status(self):
+        return {'ready': self.ready, 'phases_ms': dict(self.phases), 'startup_s': self.total, 'error': self.error}
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests.
+    While a profiled block runs, a background thread samples the stack of its thread every interval seconds.
+    If the block took longer than threshold_ms, the samples are dumped as folded stacks
+    (<out_dir>/<name>.folded, the input format of flamegraph.pl and speedscope), otherwise they are discarded.
+    Only the profiled thread is sampled, work handed to other threads shows up as waiting.
+    """
+
+    def __init__(self, threshold_ms, out_dir, interval=0.005):
+        self.threshold = threshold_ms / 1000
+        self.out_dir = out_dir
+        self.interval = interval
+        self._threads = {}
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+        threading.Thread(target=self._sample, name='profiler', daemon=True).start()
+
+    @contextmanager
+    def profile(self, name):
+        """:param name: name of the dump, or a callable returning it (called only if the block was slow)"""
+        thread_id = threading.get_ident()
+        samples = StackCounter()
+        with self._lock:
+            self._threads[thread_id] = samples
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                del self._threads[thread_id]
+            if duration >= self.threshold and samples:
+                self._dump(name, samples, duration)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._threads.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                        frame = frame.f_back
+                    samples[';'.join(reversed(stack))] += 1
+
+    def _dump(self, name, samples, duration):
+        name = name() if callable(name) else name
+        path = os.path.join(self.out_dir, f'{name}.folded')
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.warning(f'{name}: slow request ({duration * 1000:.0f} ms), profile dumped to {path}')
+
+
+def create_profiler():
+    """The slow request profiler, enabled by setting PROFILE_SLOW_MS"""
+    threshold = os.environ.get('PROFILE_SLOW_MS')
+    if not threshold:
+        return None
+    return SlowRequestProfiler(float(threshold), os.environ.get('PROFILE_DIR', 'profiles'))
+
+
+def instrument(app):
+    """
+    Tracks the duration, in-flight count and errors of every route of a Flask app, and serves them on /metrics.
+    Slow requests are profiled if PROFILE_SLOW_MS is set.
+    """
+    from flask import Response, g, request
+
+    profiler = create_profiler()
+
+    @app.before_request
+    def start_request():
+        g.metrics_endpoint = request.endpoint or 'unknown'
+        g.metrics_start = time.perf_counter()
+        IN_FLIGHT.labels(g.metrics_endpoint).inc()
+        if profiler is not None and g.metrics_endpoint != 'metrics':
+            # named after the trace id the route sets on g, if any
+            started = time.time()
+            g.metrics_profile = profiler.profile(
+                lambda: g.get('trace_id') or f'{g.metrics_endpoint}-{started:.3f}')
+            g.metrics_profile.__enter__()
+
+    @app.after_request
+    def count_errors(response):
+        # unhandled exceptions also end up here, as 500 responses
+        if response.status_code >= 500:
+            ERRORS.labels(g.get('metrics_endpoint', 'unknown')).inc()
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        if 'metrics_start' not in g:
+            return
+        if 'metrics_profile' in g:
+            g.metrics_profile.__exit__(None, None, None)
+        IN_FLIGHT.labels(g.metrics_endpoint).dec()
+        REQUEST_SECONDS.labels(g.metrics_endpoint).observe(time.perf_counter() - g.metrics_start)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument_aiohttp(app):
+    """
+    Same as instrument(), for an aiohttp app, whose routes are identified by their name.
+    The slow request profiler samples a single thread, so it doesn't apply to the event loop.
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def measure(request, handler):
+        endpoint = request.match_info.route.name or 'unknown'
+        IN_FLIGHT.labels(endpoint).inc()
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            if e.status >= 500:
+                ERRORS.labels(endpoint).inc()
+            raise
+        except Exception:
+            ERRORS.labels(endpoint).inc()
+            raise
+        finally:
+            IN_FLIGHT.labels(endpoint).dec()
+            REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+        if response.status >= 500:
+            ERRORS.labels(endpoint).inc()
+        return response
+
+    async def metrics(request):
+        return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    app.middlewares.append(measure)
+    app.router.add_get('/metrics', metrics, name='metrics')
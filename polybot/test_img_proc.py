@@ -0,0 +1,131 @@
+import io
+
+import numpy as np
+import pytest
+from matplotlib.image import imsave
+from PIL import Image
+
+from img_proc import Img, blur, contour, parse_pipeline
+
+
+def list_blur(data, blur_level=16):
+    """The original list implementation of Img.blur"""
+    height = len(data)
+    width = len(data[0])
+    filter_sum = blur_level ** 2
+
+    result = []
+    for i in range(height - blur_level + 1):
+        row_result = []
+        for j in range(width - blur_level + 1):
+            sub_matrix = [row[j:j + blur_level] for row in data[i:i + blur_level]]
+            average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
+            row_result.append(average)
+        result.append(row_result)
+    return result
+
+
+def list_contour(data):
+    """The original list implementation of Img.contour"""
+    return [[abs(row[j - 1] - row[j]) for j in range(1, len(row))] for row in data]
+
+
+def gray(height, width, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width), dtype=np.uint8)
+
+
+def image(data):
+    buf = io.BytesIO()
+    Image.fromarray(data).save(buf, format='png')
+    return Img('photo.png', fileobj=io.BytesIO(buf.getvalue()))
+
+
+def run_sequential(img, pipeline):
+    for name, args in pipeline.steps:
+        if name == 'concat':
+            img.concat(img)
+        elif name == 'rotate':
+            for _ in range(args[0] if args else 1):
+                img.rotate()
+        else:
+            getattr(img, name)(*args)
+    return img
+
+
+@pytest.mark.parametrize('blur_level', [1, 3, 16])
+def test_blur_matches_list_implementation(blur_level):
+    data = gray(37, 53)
+    assert blur(data, blur_level).tolist() == list_blur(data.astype(int).tolist(), blur_level)
+
+
+def test_contour_matches_list_implementation():
+    data = gray(19, 23)
+    assert contour(data).tolist() == list_contour(data.astype(int).tolist())
+
+
+def test_img_keeps_uint8_gray_levels():
+    data = gray(20, 30)
+    img = image(data)
+    assert img.data.dtype == np.uint8
+    assert np.array_equal(img.data, data)
+
+
+def test_encode_matches_save_img():
+    img = image(gray(20, 30))
+    img.blur(3)
+    expected = io.BytesIO()
+    imsave(expected, img.data, cmap='gray', format='png')
+
+    encoded = np.array(Image.open(io.BytesIO(img.encode())))
+    assert np.array_equal(encoded, np.array(Image.open(expected).convert('L')))
+
+
+@pytest.mark.parametrize('spec', [
+    'blur(4) | contour | rotate',
+    'rotate | rotate | rotate | rotate | blur(2)',
+    'concat | contour',
+    'rotate(3) | concat | blur(5) | contour | rotate(2)',
+    'contour | blur(3) | concat | concat',
+])
+def test_pipeline_matches_sequential_filters(spec):
+    data = gray(41, 29)
+    pipeline = parse_pipeline(spec)
+    assert np.array_equal(pipeline.apply(image(data)).data, run_sequential(image(data), pipeline).data)
+
+
+def test_pipeline_salt_n_pepper_leaves_the_original_image():
+    data = gray(30, 40)
+    img = image(data)
+    original = img.data
+
+    np.random.seed(0)
+    parse_pipeline('salt_n_pepper(0.2) | rotate').apply(img)
+    np.random.seed(0)
+    expected = run_sequential(image(data), parse_pipeline('salt_n_pepper(0.2) | rotate'))
+
+    assert np.array_equal(img.data, expected.data)
+    assert np.array_equal(original, data)
+
+
+def test_pipeline_fuses_rotations():
+    assert parse_pipeline('rotate | rotate(2) | blur | rotate(4)').fused() == [('rotate', (3,)), ('blur', ())]
+
+
+def test_pipeline_rejects_images_too_small():
+    with pytest.raises(ValueError, match='too small'):
+        parse_pipeline('blur(16) | blur(16)').apply(image(gray(20, 40)))
+
+
+def test_pipeline_rejects_images_too_large(monkeypatch):
+    monkeypatch.setattr('img_proc.MAX_PIXELS', 4 * 20 * 30)
+    parse_pipeline('concat | concat').apply(image(gray(20, 30)))
+    with pytest.raises(ValueError, match='too large'):
+        parse_pipeline('concat | concat | concat').apply(image(gray(20, 30)))
+
+
+@pytest.mark.parametrize('spec', [
+    'sharpen', 'blur(0)', 'blur(2.5)', 'blur(1, 2)', 'contour(1)', 'blur(import os)', ' | '.join(['rotate'] * 11),
+])
+def test_parse_pipeline_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        parse_pipeline(spec)
@@ -0,0 +1,93 @@
+import asyncio
+import functools
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from loguru import logger
+from img_proc import Img, Pipeline
+
+# Telegram keeps photos at most 2560 pixels wide, larger images are decoded at a reduced resolution
+MAX_SIDE = int(os.environ.get('IMG_MAX_SIDE', 2560))
+
+
+def filter_image_bytes(data, filters, name='photo.jpg'):
+    """
+    Runs Img filters on an encoded image in memory, executed inside a worker process. Nothing is written to disk.
+    :param filters: a Pipeline, run in a single pass, or the name of a single filter
+    :return: the filtered image, encoded once in the format of name
+    """
+    image = Img(name, fileobj=io.BytesIO(data), max_side=MAX_SIDE)
+    if isinstance(filters, Pipeline):
+        filters.apply(image)
+    else:
+        getattr(image, filters)()
+    return image.encode()
+
+
+class ChatWorkerPool:
+    """
+    Runs the bot jobs off the webhook handler, as tasks of the event loop.
+    Jobs of the same chat run one after the other, in the order they were submitted, while jobs of different
+    chats run concurrently. CPU bound filters are sent to a bounded pool of worker processes,
+    and the blocking calls (boto3, the jobs queue) to a pool of threads.
+    Apart from the constructor, its methods must be called from the event loop.
+    """
+
+    def __init__(self, max_workers=None, max_pending=100, max_threads=None):
+        max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self._processes = ProcessPoolExecutor(max_workers)
+        # start the worker processes now, before the event loop and its threads are started
+        self._processes.submit(int).result()
+        self._threads = ThreadPoolExecutor(max_workers=max_threads or 2 * max_workers, thread_name_prefix='blocking')
+        self._chats = {}
+        self._tasks = set()
+        self._pending = 0
+
+    def submit(self, chat_id, job):
+        """
+        Queues job (a coroutine function without arguments) behind the previous jobs of chat_id.
+        :return: False if the pool is full and the job was rejected, else True
+        """
+        if self._pending >= self.max_pending:
+            return False
+        self._pending += 1
+
+        jobs = self._chats.setdefault(chat_id, deque())
+        jobs.append(job)
+        if len(jobs) == 1:
+            # the loop only keeps weak references to its tasks
+            task = asyncio.ensure_future(self._drain(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def run_filter_bytes(self, data, filters, name='photo.jpg'):
+        """Runs a filter or a Pipeline on an encoded image in a worker process and waits for the filtered image bytes"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._processes, filter_image_bytes, data, filters, name)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Runs a blocking call in a thread and waits for its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._threads, functools.partial(fn, *args, **kwargs))
+
+    async def _drain(self, chat_id):
+        jobs = self._chats[chat_id]
+        while jobs:
+            try:
+                await jobs[0]()
+            except Exception:
+                logger.exception(f'chat {chat_id}: job failed')
+            self._pending -= 1
+            jobs.popleft()
+        del self._chats[chat_id]
+
+    async def shutdown(self):
+        """Waits for the queued jobs, then stops the worker processes and threads"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+        self._threads.shutdown(wait=True)
+        self._processes.shutdown(wait=True)
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class Rejected(Exception):
+    """A request refused by the admission control, the client should retry after retry_after seconds"""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(f'{reason.replace("_", " ")}, retry after {retry_after:.1f}s')
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class RateLimiter:
+    """
+    Token bucket per client: a client can send bursts of up to burst requests, then rate requests per second.
+    Only the max_clients most recently seen clients are remembered, the oldest ones have a full bucket again anyway.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> (tokens, time they were counted)
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """:return: 0 if client can send a request now (it is counted), else the seconds until it can"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1 if tokens >= 1 else tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class AdmissionController:
+    """
+    Admission control of the predictions.
+    At most max_concurrent requests run at once, the next ones wait in a FIFO queue of at most max_queue requests,
+    so a burst is served at the pace of the model instead of every request competing for the CPU.
+    A request is rejected right away rather than queued when:
+    - its client is over its rate (429)
+    - the queue is full, or the request would not complete before the timeout of the caller given its estimated
+      wait (503). The wait is estimated from the average service time of the recent requests (moving average)
+    Rejections carry the time after which a retry has a chance to be admitted.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32, rate_limiter=None, service_time=1.0, smoothing=0.1):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.rate_limiter = rate_limiter
+        self.service_time = service_time
+        self.smoothing = smoothing
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._queue = deque()
+        self._stats = {'admitted': 0, 'queued': 0, 'rate_limited': 0, 'queue_full': 0, 'deadline': 0, 'timeout': 0}
+
+    def estimated_wait(self, position):
+        """Seconds before the request at position in the queue (0 for the first one) can start"""
+        return (position + 1) * self.service_time / self.max_concurrent
+
+    @contextmanager
+    def admit(self, client=None, timeout=None):
+        """
+        Runs the block once a slot is free.
+        :param client: key of the rate limit (e.g. the chat id), None to not rate limit the request
+        :param timeout: seconds the caller waits for the response, None to wait as long as needed
+        :raise Rejected: if the request is rejected, before the block runs
+        """
+        if client is not None and self.rate_limiter is not None:
+            retry_after = self.rate_limiter.take(client)
+            if retry_after:
+                self._reject(429, retry_after, 'rate_limited')
+
+        with self._cond:
+            if self._running >= self.max_concurrent or self._queue:
+                self._wait_turn(timeout)
+            self._running += 1
+            self._stats['admitted'] += 1
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self.service_time += self.smoothing * (time.perf_counter() - start - self.service_time)
+                self._cond.notify_all()
+
+    def _wait_turn(self, timeout):
+        """Waits in the queue until the request is first and a slot is free, called with the lock held"""
+        position = len(self._queue)
+        wait = self.estimated_wait(position)
+        if position >= self.max_queue:
+            self._reject(503, wait, 'queue_full')
+        if timeout is not None and wait + self.service_time > timeout:
+            self._reject(503, wait, 'deadline')
+
+        self._stats['queued'] += 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        self._queue.append(ticket)
+        try:
+            while self._queue[0] is not ticket or self._running >= self.max_concurrent:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    # the estimate was too optimistic, the caller already gave up
+                    self._reject(503, self.estimated_wait(self._queue.index(ticket)), 'timeout')
+                self._cond.wait(remaining)
+        finally:
+            self._queue.remove(ticket)
+            # the next request may be first now
+            self._cond.notify_all()
+
+    def _reject(self, status, retry_after, reason):
+        with self._cond:
+            self._stats[reason] += 1
+        raise Rejected(status, retry_after, reason)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, running=self._running, waiting=len(self._queue),
+                        service_time_ms=self.service_time * 1000)
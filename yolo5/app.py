@@ -1,136 +1,533 @@
+import hashlib
+import io
+import math
+import threading
 import time
-from pathlib import Path
-from flask import Flask, request
-from detect import run
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import Flask, Response, g, request, stream_with_context
+import cv2
+import numpy as np
 import uuid
-import yaml
 from loguru import logger
 import os
-import boto3
 from botocore.exceptions import ClientError
-#import requests
-#from pymongo import MongoClient
+from admission import AdmissionController, RateLimiter, Rejected
+from engine import InferenceEngine
+from batcher import MicroBatcher
+from cache import PredictionCache, cache_key
+from pymongo import MongoClient
+from job_queue import get_queue_client
+from worker import QueueWorker
+from write_behind import WriteBehindUploader
+from mongo_writer import BufferedMongoWriter, parse_write_concern
+from metrics import Startup, instrument, observe, span
+from summary import parse_options, prediction_view, summarize
+from prometheus_client import Counter, Gauge
+import json
+from clients import get_s3_client, get_http_session, connection_stats
 
 # Specify the bucket name
 bucket_name = os.environ['BUCKET_NAME']
 
-# Initialize S3 client
-s3 = boto3.client('s3')
+# Prediction jobs sent by the bot, and where to push their results
+jobs_queue_url = os.environ.get('JOBS_QUEUE_URL')
+bot_url = os.environ.get('BOT_URL', 'http://telegram_bot:8443')
 
-# Initialize Flask app
+# Shared S3 client and HTTP session, connections are pooled and reused across requests
+s3 = get_s3_client()
+http = get_http_session()
+
+# Initialize MongoDB client, optional: the service also works without it
+mongo_uri = os.environ.get('MONGO_URI')
+if mongo_uri == 'mongomock://':
+    # in-process stand-in, used by the benchmarks
+    import mongomock
+    mongo_client = mongomock.MongoClient()
+else:
+    mongo_client = MongoClient(mongo_uri) if mongo_uri else None
+mongo_db = mongo_client[os.environ.get('MONGO_DB', 'mongodb')] if mongo_client else None
+
+# Initialize Flask app, its routes are measured and exposed on /metrics
 app = Flask(__name__)
+instrument(app)
+
+# The server listens as soon as it starts (/healthz), while the model is loaded and warmed up in the background,
+# the replica reports ready (/readyz) and serves predictions once the model is warm. See start()
+startup = Startup()
+
+# The model, loaded once by start(), it stays resident for all the requests
+engine = None
+# warmed up on this sample image, bundled with yolov5
+warmup_image = os.environ.get('YOLO_WARMUP_IMAGE', 'data/images/bus.jpg')
+
+# Tiled predictions: overlap between neighbour tiles, and tiles run per forward pass (bounds the memory used)
+tile_overlap = float(os.environ.get('TILE_OVERLAP', 0.2))
+tile_batch_size = int(os.environ.get('TILE_BATCH_SIZE', 8))
+
+# /predict_batch: concurrent S3 downloads and predictions per call, and max keys listed in a call
+predict_batch_workers = int(os.environ.get('PREDICT_BATCH_WORKERS', 8))
+predict_batch_max_keys = int(os.environ.get('PREDICT_BATCH_MAX_KEYS', 10000))
+
+# Concurrent /predict calls are grouped into a single forward pass, created by start() along with the engine
+batcher = None
+
+# Admission control of /predict: concurrent predictions, and the queue of the requests waiting for one of them.
+# Requests that can't complete within the timeout of the caller (X-Request-Timeout header, in seconds) are rejected
+# right away, and every chat can send bursts of up to PREDICT_CHAT_BURST photos, then PREDICT_CHAT_RATE per second
+predict_chat_rate = float(os.environ.get('PREDICT_CHAT_RATE', 1))
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get('PREDICT_MAX_CONCURRENT', 8)),
+    max_queue=int(os.environ.get('PREDICT_MAX_QUEUE', 32)),
+    rate_limiter=RateLimiter(predict_chat_rate, float(os.environ.get('PREDICT_CHAT_BURST', 5)))
+    if predict_chat_rate > 0 else None,
+)
+default_request_timeout = float(os.environ.get('PREDICT_DEFAULT_TIMEOUT', 60))
+
+# Prediction summaries are persisted to MongoDB in batches, off the response path
+if mongo_db is not None:
+    predictions_writer = BufferedMongoWriter(
+        mongo_db[os.environ.get('MONGO_COLLECTION', 'predictions')],
+        flush_size=int(os.environ.get('MONGO_FLUSH_SIZE', 100)),
+        flush_interval=float(os.environ.get('MONGO_FLUSH_INTERVAL_MS', 1000)) / 1000,
+        max_buffer=int(os.environ.get('MONGO_MAX_BUFFER', 10000)),
+        write_concern=parse_write_concern(
+            os.environ.get('MONGO_WRITE_CONCERN', '1'),
+            wtimeout_ms=int(os.environ.get('MONGO_WTIMEOUT_MS', 5000)),
+        ),
+    )
+else:
+    predictions_writer = None
+
+# S3 uploads are written behind, off the response path
+uploader = WriteBehindUploader(
+    s3,
+    bucket_name,
+    max_workers=int(os.environ.get('UPLOAD_WORKERS', 4)),
+    max_pending=int(os.environ.get('UPLOAD_MAX_PENDING', 64)),
+)
+
+# Background queues, exposed on /metrics
+Gauge('batch_queue_depth', 'Images waiting for a batch').set_function(
+    lambda: batcher.stats()['queue_depth'] if batcher is not None else 0)
+Gauge('upload_pending', 'S3 uploads waiting to be written').set_function(lambda: uploader.stats()['pending'])
+Gauge('admission_waiting', 'Predictions waiting to be admitted').set_function(
+    lambda: admission.stats()['waiting'])
+Gauge('admission_running', 'Predictions admitted and running').set_function(lambda: admission.stats()['running'])
+rejections = Counter('admission_rejections_total', 'Predictions rejected by the admission control', ['reason'])
+if predictions_writer is not None:
+    Gauge('mongo_buffered', 'Prediction summaries waiting to be written to MongoDB').set_function(
+        lambda: predictions_writer.stats()['buffered'])
 
-def upload_file(file_name, bucket, object_name=None):
-    """Upload a file to an S3 bucket
+# Largest image accepted in the body of /predict
+max_image_bytes = int(os.environ.get('MAX_IMAGE_BYTES', 20 * 1024 * 1024))
+# leaves room for the multipart headers
+app.config['MAX_CONTENT_LENGTH'] = max_image_bytes + 64 * 1024
 
-    :param file_name: File to upload
-    :param bucket: Bucket to upload to
-    :param object_name: S3 object name. If not specified then file_name is used
-    :return: True if file was uploaded, else False
+# Predictions of images that were already seen, keyed by the image content and the model version
+prediction_cache = PredictionCache(
+    max_size=int(os.environ.get('CACHE_SIZE', 1024)),
+    collection=mongo_db['prediction_cache'] if mongo_db is not None else None,
+    ttl_seconds=int(os.environ.get('CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+    lookup_timeout_ms=float(os.environ.get('CACHE_LOOKUP_TIMEOUT_MS', 200)),
+)
+
+
+def start():
+    """
+    Startup phases, run in the background while the server already listens: loads the model and warms it up,
+    then starts consuming the prediction jobs. Their durations are reported by /readyz and /metrics.
     """
+    global engine, batcher
+    with startup.phase('load_model'):
+        engine = InferenceEngine(
+            weights=os.environ.get('YOLO_WEIGHTS', 'yolov5s.pt'),
+            data='data/coco128.yaml',
+            imgsz=int(os.environ.get('YOLO_IMG_SIZE', 640)),
+            # torch, or onnx to run an ONNX Runtime export of the weights (YOLO_INT8=1 for its INT8 quantized version)
+            backend=os.environ.get('YOLO_BACKEND', 'torch'),
+            int8=os.environ.get('YOLO_INT8', '0') == '1',
+            threads=int(os.environ.get('YOLO_THREADS', 0)),
+            warmup_runs=0,
+        )
 
-    # If S3 object_name was not specified, use file_name
-    if object_name is None:
-        object_name = os.path.basename(file_name)
+    with startup.phase('warmup'):
+        sample = cv2.imread(warmup_image)
+        if sample is None:
+            logger.warning(f'startup: warmup image {warmup_image} could not be read, warming up on a blank input')
+        engine.warmup([sample, sample] if sample is not None else None)
+
+    batcher = MicroBatcher(
+        engine,
+        max_batch_size=int(os.environ.get('BATCH_MAX_SIZE', 8)),
+        max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', 10)),
+    )
+    startup.set_ready()
+
+    if jobs_queue_url:
+        QueueWorker(
+            get_queue_client(),
+            jobs_queue_url,
+            handle_job,
+            num_threads=int(os.environ.get('JOB_WORKERS', 2)),
+            max_receives=int(os.environ.get('JOBS_MAX_RECEIVES', 5)),
+            dead_letter_url=os.environ.get('JOBS_DEAD_LETTER_QUEUE_URL'),
+        ).start()
+
+    # once ready, MongoDB is off the serving path: while its replica set is unreachable the index creations wait
+    # for the server selection timeout, and the writes they speed up are buffered meanwhile
+    if mongo_db is not None:
+        with startup.phase('mongo_indexes'):
+            predictions_writer.create_indexes()
+            prediction_cache.create_indexes()
+
+
+@app.before_request
+def wait_for_startup():
+    # the routes that need the model are refused until it is warm, the client can retry on another replica
+    if request.endpoint in ('predict', 'predict_batch') and not startup.ready:
+        return 'the model is not loaded yet', 503, {'Retry-After': '5'}
 
-    # Upload the file
-    s3_client = boto3.client('s3')
-    try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
-    except ClientError as e:
-        logger.error(e)
-        return False
-    return True
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process serves requests, it only fails if the startup failed"""
+    if startup.error:
+        return startup.status(), 500
+    return 'Ok'
 
-# Initialize MongoDB client (replace with your MongoDB connection details)
-#client = MongoClient('mongodb://localhost:27017/')
-#db = client['mongodb']
-#collection = db['myReplicaSet']  # Use your collection name here
 
-# Load COCO names
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']predict
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: the model is loaded and warm, with the durations of the startup phases"""
+    return startup.status(), 200 if startup.ready else 503
+
+
+def decode_image(data):
+    """Decode encoded image bytes (jpeg, png...) straight into a BGR array, None if they can't be decoded"""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_image(img, ext='.jpg'):
+    """Encode a BGR array into an in-memory buffer ready to be uploaded"""
+    ok, buf = cv2.imencode(ext, img)
+    if not ok:
+        raise ValueError(f'could not encode image as {ext}')
+    return io.BytesIO(buf.tobytes())
+
+
+def read_image_body(stream, chunk_size=64 * 1024):
+    """Reads a streamed request body chunk by chunk, None if it is larger than max_image_bytes"""
+    buf = io.BytesIO()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return buf.getvalue()
+        buf.write(chunk)
+        if buf.tell() > max_image_bytes:
+            return None
+
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    # Generates a UUID for this current prediction HTTP request.
-    # This id can be used as a reference in logs to identify and track individual prediction requests.
-    prediction_id = str(uuid.uuid4())
+    # Generates a UUID for this current prediction HTTP request, unless the caller already assigned one.
+    # This id can be used as a reference in logs and timing spans to identify and track individual prediction requests.
+    prediction_id = request.args.get('predictionId') or str(uuid.uuid4())
+    g.trace_id = prediction_id
     logger.info(f'prediction: {prediction_id}. start processing')
 
-    # Receives a URL parameter representing the image to download from S3
+    # Receives a URL parameter representing the image name in S3, and optionally the chat it was sent from
     img_name = request.args.get('imgName')
+    chat_id = request.args.get('chatId')
+    # large images (phone photos, drone shots) can be predicted tile by tile, to keep the small objects
+    tiled = request.args.get('tiled', 'false').lower() in ('1', 'true')
+    # confidence threshold and top-k of the returned detections, boxes=false to only get their per-class summary
+    try:
+        options = parse_options(request.args)
+        timeout = float(request.headers.get('X-Request-Timeout', default_request_timeout))
+    except ValueError as e:
+        return f'prediction: {prediction_id}. {e}', 400
+
+    # Admitted before the body is read, a rejected request costs next to nothing
+    queued = time.perf_counter()
+    try:
+        with admission.admit(chat_id, timeout):
+            observe('admission_wait', time.perf_counter() - queued, prediction_id)
+            return predict_request(prediction_id, img_name, chat_id, tiled, options)
+    except Rejected as e:
+        rejections.labels(e.reason).inc()
+        logger.warning(f'prediction: {prediction_id}. rejected: {e}')
+        return f'prediction: {prediction_id}. {e}', e.status, {'Retry-After': str(math.ceil(e.retry_after))}
+
 
-    # Specify the local path to save the downloaded image
+def predict_request(prediction_id, img_name, chat_id, tiled, options):
+    """Predicts the image of a /predict request, sent in the request or in S3"""
+    # The image itself can also be sent in the request, as a multipart 'image' field or as the raw body,
+    # that saves the S3 upload by the client and the S3 download here
+    if request.mimetype == 'multipart/form-data' and 'image' in request.files:
+        with span('receive', prediction_id):
+            data = request.files['image'].read()
+    elif request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        with span('receive', prediction_id):
+            data = read_image_body(request.stream)
+    elif img_name:
+        return answer(process_prediction(prediction_id, img_name, chat_id, tiled=tiled), options)
+    else:
+        return f'prediction: {prediction_id}. no image: send it in the request or name it with imgName', 400
+
+    if data is None or len(data) > max_image_bytes:
+        return f'prediction: {prediction_id}. image larger than {max_image_bytes} bytes', 413
+    if not data:
+        return f'prediction: {prediction_id}. empty image', 400
+
+    return answer(predict_image_bytes(prediction_id, data, img_name or f'{prediction_id}.jpeg', chat_id=chat_id,
+                                      persist_original=True, tiled=tiled), options)
 
-    #img_path =img_name.split('/')[-1]
-    local_dir = 'photos/'
-    os.makedirs(local_dir, exist_ok=True)
-    #local_image_path = os.path.join(local_dir, img_name)  # Concatenate local_dir with img_path
-    original_img_path = local_dir + img_name
 
+def answer(response, options):
+    """Applies the options of a request (see summary.parse_options) to a (prediction, HTTP status code) response"""
+    result, status = response
+    return (prediction_view(result, **options) if status == 200 else result), status
 
-    # TODO download img_name from S3, store the local image path in original_img_path
-    # Download the image from S3
+
+def model_version(tiled):
+    """
+    Version of the detections, tiled predictions are cached apart from the whole image ones.
+    It also names the format of the cached predictions, those of a previous format are not reused
+    """
+    version = f'{engine.version}-columns'
+    return f'{version}-tiled' if tiled else version
+
+
+def process_prediction(prediction_id, img_name, chat_id=None, tiled=False):
+    """
+    Predicts the objects of the S3 image img_name, shared by the /predict route and the queue worker
+    :return: tuple of (prediction summary, or an error message, HTTP status code)
+    """
+    # The S3 ETag is the MD5 of the object content for non multipart uploads,
+    # so a resent photo can be recognized without downloading it
     try:
-        s3.download_file(bucket_name, img_name, original_img_path)
-        logger.info(f'prediction: {prediction_id}/{original_img_path}. Download img completed')
+        with span('s3_head', prediction_id):
+            etag = s3.head_object(Bucket=bucket_name, Key=img_name)['ETag']
+    except ClientError as e:
+        logger.error(f'Error reading image metadata: {e}')
+        return f'prediction: {prediction_id}/{img_name}. image could not be downloaded', 404
 
+    key = cache_key(etag.strip('"'), model_version(tiled)) if '-' not in etag else None
+    cached = prediction_cache.get(key) if key else None
+    if cached is not None:
+        logger.info(f'prediction: {prediction_id}/{img_name}. cache hit of prediction {cached["prediction_id"]}')
+        return dict(cached, cache_hit=True), 200
+
+    # Download the image from S3 and decode it in memory, nothing is written to local disk.
+    # IfMatch: the image must be the one looked up, or its detections would be cached under the ETag of another one
+    try:
+        with span('s3_download', prediction_id):
+            data = s3.get_object(Bucket=bucket_name, Key=img_name, IfMatch=etag)['Body'].read()
+        logger.info(f'prediction: {prediction_id}/{img_name}. Download img completed')
     except ClientError as e:
-       logger.error(f'Error downloading image: {e}')
-
-    # Predicts the objects in the image
-    run(
-        weights='yolov5s.pt',
-        data='data/coco128.yaml',
-        source=original_img_path, # Use the correct COCO YAML path
-        project='static/data',
-        name=prediction_id,
-        save_txt=True
-    )
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+            logger.error(f'prediction: {prediction_id}/{img_name}. image replaced while it was downloaded')
+            return f'prediction: {prediction_id}/{img_name}. image replaced while it was downloaded', 409
+        logger.error(f'Error downloading image: {e}')
+        return f'prediction: {prediction_id}/{img_name}. image could not be downloaded', 404
+
+    return predict_image_bytes(prediction_id, data, img_name, chat_id=chat_id, key=key, tiled=tiled)
+
+
+def predict_image_bytes(prediction_id, data, img_name, chat_id=None, key=None, persist_original=False, tiled=False):
+    """
+    Predicts the objects of an encoded image, as a whole through the micro batcher or tile by tile if tiled.
+    The S3 uploads (the original image if persist_original, and the predicted image) are written behind,
+    after the response is returned.
+    :param key: cache key of the image, computed from its bytes if not given
+    :return: tuple of (prediction summary, or an error message, HTTP status code)
+    """
+    if key is None:
+        key = cache_key(hashlib.md5(data).hexdigest(), model_version(tiled))
+        cached = prediction_cache.get(key)
+        if cached is not None:
+            logger.info(f'prediction: {prediction_id}/{img_name}. cache hit of prediction {cached["prediction_id"]}')
+            return dict(cached, cache_hit=True), 200
+
+    with span('decode', prediction_id):
+        img = decode_image(data)
+    if img is None:
+        return f'prediction: {prediction_id}/{img_name}. image could not be decoded', 400
+
+    if persist_original:
+        uploader.submit(img_name, data)
+
+    # Predicts the objects in the image, the tiles of an image are already a batch of their own
+    if tiled:
+        detections, timings = engine.predict_tiled(img, overlap=tile_overlap, max_batch_size=tile_batch_size)
+    else:
+        detections, timings = batcher.predict(img)
+    for stage in ('queue_wait', 'preprocess', 'inference', 'nms'):
+        if stage in timings:
+            observe(stage, timings[stage] / 1000, prediction_id)
 
-    logger.info(f'prediction: {prediction_id}/{original_img_path}. done')
-
-    # This is the path for the predicted image with labels
-    predicted_img_path = f'static/data/{prediction_id}/{img_name}'
-
-    # TODO Uploads the predicted image (predicted_img_path) to S3 (be careful not to override the original image).
-    path_to_upload= f'prediction {img_name}'
-    upload_file(predicted_img_path, bucket_name, path_to_upload)
-
-
-    # Parse prediction labels and create a summary
-    pred_summary_path = Path(f'static/data/{prediction_id}/labels/{img_name.split(".")[0]}.txt')
-    logger.info(f'prediction: {pred_summary_path}')
-    if pred_summary_path.exists():
-        with open(pred_summary_path) as f:
-            labels = f.read().splitlines()
-            labels = [line.split(' ') for line in labels]
-            labels = [{
-                'class': names[int(l[0])],
-                'cx': float(l[1]),
-                'cy': float(l[2]),
-                'width': float(l[3]),
-                'height': float(l[4]),
-            } for l in labels]
-
-        logger.info(f'prediction: {prediction_id}/{original_img_path}. prediction summary:\n\n{labels}')
-
-        prediction_summary = {
-            'prediction_id': prediction_id,
-            'original_img_path': original_img_path,
-            'predicted_img_path': str(predicted_img_path),
-            'labels': labels,
-            'time': time.time()
-        }
-
-        # TODO store the prediction_summary in MongoDB
-        #collection.insert_one(prediction_summary)
-
-        return prediction_summary
+    logger.info(f'prediction: {prediction_id}/{img_name}. done, timings (ms): {timings}')
+
+    # The predicted image with labels is rendered and uploaded in the background
+    # (under a different key, to not override the original image)
+    predicted_img_path = f'prediction {img_name}'
+    ext = os.path.splitext(img_name)[1] or '.jpg'
+    uploader.submit(predicted_img_path, lambda: encode_image(engine.annotate(img, detections), ext))
+
+    # Create a summary straight from the detections, they are kept as columns, with all their confidences
+    with span('summarize', prediction_id):
+        columns = detections.to_columns(engine.names)
+        summary = summarize(columns)
+
+    logger.info(f'prediction: {prediction_id}/{img_name}. prediction summary: {summary}')
+
+    prediction_summary = {
+        'prediction_id': prediction_id,
+        'chat_id': chat_id,
+        'original_img_path': img_name,
+        'predicted_img_path': predicted_img_path,
+        'detections': columns,
+        'summary': summary,
+        'timings': timings,
+        'time': time.time()
+    }
+
+    prediction_cache.put(key, prediction_summary)
+
+    if predictions_writer is not None:
+        predictions_writer.add(prediction_summary)
+
+    return dict(prediction_summary, cache_hit=False), 200
+
+
+def handle_job(message):
+    """Runs a prediction job received from the queue and pushes the result back to the bot"""
+    job = json.loads(message['Body'])
+    prediction_id = job.get('prediction_id') or str(uuid.uuid4())
+    logger.info(f'prediction: {prediction_id}. start processing job {message["MessageId"]}')
+
+    try:
+        # the bot only reads the summary of the detections
+        options = dict(parse_options(job), boxes=False)
+    except ValueError as e:
+        result, status = str(e), 400
     else:
-        return f'prediction: {prediction_id}/{original_img_path}. prediction result not found', 404
+        result, status = answer(process_prediction(prediction_id, job['imgName'], str(job['chat_id']),
+                                                   tiled=job.get('tiled', False)), options)
+    if status == 200:
+        payload = {'chat_id': job['chat_id'], 'prediction': result}
+    else:
+        payload = {'chat_id': job['chat_id'], 'error': result}
+
+    # raising leaves the message in the queue, it is retried after its visibility timeout
+    with span('push_result', prediction_id):
+        response = http.post(f'{bot_url}/results', json=payload, timeout=30)
+        response.raise_for_status()
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Predicts many S3 images in one call, given as a JSON body {"keys": [...]} or {"prefix": "..."},
+    optionally with "tiled": true, "chat_id", and the "conf", "top_k" and "boxes" options of /predict.
+    The results are streamed as NDJSON while the images are processed, one line per key in completion order:
+    {"key", "status": 200, "prediction"} or {"key", "status", "error"}, then a last {"done": true, ...} line.
+    """
+    batch_id = request.args.get('batchId') or str(uuid.uuid4())
+    g.trace_id = batch_id
+    body = request.get_json(silent=True) or {}
+    tiled = bool(body.get('tiled', False))
+    chat_id = body.get('chat_id')
+    try:
+        options = parse_options(body)
+    except ValueError as e:
+        return f'batch: {batch_id}. {e}', 400
+
+    if isinstance(body.get('keys'), list):
+        if len(body['keys']) > predict_batch_max_keys:
+            return f'batch: {batch_id}. more than {predict_batch_max_keys} keys', 413
+        keys = iter(body['keys'])
+    elif isinstance(body.get('prefix'), str):
+        keys = list_image_keys(body['prefix'])
+    else:
+        return f'batch: {batch_id}. a list of "keys" or a "prefix" is expected', 400
+
+    logger.info(f'batch: {batch_id}. start processing')
+    lines = (json.dumps(result) + '\n' for result in predict_keys(batch_id, keys, chat_id, tiled, options))
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+def list_image_keys(prefix):
+    """Keys of the S3 images under prefix, listed lazily page by page, without the predicted images"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].startswith('prediction '):
+                yield obj['Key']
+
+
+def predict_keys(batch_id, keys, chat_id=None, tiled=False, options=None):
+    """
+    Predicts the S3 images keys with predict_batch_workers threads, yields their results as they complete.
+    At most twice as many keys as threads are in flight, so a large prefix is never held in memory at once,
+    and the concurrent predictions are grouped into batches by the micro batcher.
+    """
+    start = time.perf_counter()
+    total = failed = 0
+
+    def run(i, key):
+        try:
+            result, status = answer(process_prediction(f'{batch_id}-{i}', key, chat_id, tiled=tiled), options or {})
+        except Exception as e:
+            logger.exception(f'batch: {batch_id}. prediction of {key} failed')
+            result, status = str(e), 500
+        if status == 200:
+            return {'key': key, 'status': status, 'prediction': result}
+        return {'key': key, 'status': status, 'error': result}
+
+    with ThreadPoolExecutor(max_workers=predict_batch_workers, thread_name_prefix='predict-batch') as executor:
+        pending = set()
+
+        def completed():
+            nonlocal pending
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            return [future.result() for future in done]
+
+        keys = enumerate(keys)
+        while True:
+            key = next(keys, None)
+            if key is not None:
+                pending.add(executor.submit(run, *key))
+            if not pending:
+                break
+            if key is None or len(pending) >= 2 * predict_batch_workers:
+                for result in completed():
+                    total, failed = total + 1, failed + (result['status'] != 200)
+                    yield result
+
+    elapsed = time.perf_counter() - start
+    logger.info(f'batch: {batch_id}. done, {total} keys ({failed} failed) in {elapsed:.1f}s')
+    yield {'done': True, 'batch_id': batch_id, 'total': total, 'failed': failed, 'elapsed_ms': elapsed * 1000}
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return {
+        'startup': startup.status(),
+        'engine': {
+            'backend': engine.backend.name,
+            'model': engine.backend.path,
+            'device': str(engine.device),
+            'imgsz': list(engine.imgsz),
+            'load_time': engine.load_time,
+        } if engine is not None else None,
+        'batcher': batcher.stats() if batcher is not None else None,
+        'cache': prediction_cache.stats(),
+        'connections': connection_stats(),
+        'uploads': uploader.stats(),
+        'admission': admission.stats(),
+        'mongo_writer': predictions_writer.stats() if predictions_writer is not None else None,
+    }
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8081)
+    threading.Thread(target=start, name='startup', daemon=True).start()
+    app.run(host='0.0.0.0', port=8081, threaded=True)
@@ -0,0 +1,212 @@
+"""
+Inference backends of the InferenceEngine.
+
+A backend runs the YOLOv5 network on a preprocessed batch (float NCHW tensor scaled to [0, 1]) and returns
+its raw predictions, the engine does the letterboxing before and the NMS after, whatever the backend.
+
+- torch: the PyTorch checkpoint, through yolov5's DetectMultiBackend
+- onnx: an ONNX export of the same checkpoint run by ONNX Runtime, optionally with INT8 quantized weights.
+  The export is created next to the weights the first time it is needed, or ahead of time with:
+
+      python backends.py yolov5s.pt --imgsz 640 --int8
+"""
+import argparse
+import ast
+import inspect
+import os
+import time
+
+import numpy as np
+import torch
+from loguru import logger
+
+from models.common import DetectMultiBackend
+
+BACKENDS = ('torch', 'onnx')
+
+
+class Backend:
+    """
+    Common interface of the backends:
+    - names: dict of class index to class name
+    - stride: max stride of the network, the input size must be a multiple of it
+    - fp16: whether the input batch must be half precision
+    - dynamic: whether the input can have any (stride multiple) shape, for rectangular inference
+    - path: file of the model actually run, it identifies the detections in the prediction cache
+    """
+    name = None
+    names = None
+    stride = 32
+    fp16 = False
+    dynamic = False
+    path = None
+
+    def __call__(self, batch):
+        """:return: the raw predictions tensor of the batch, (batch size, anchors, 5 + number of classes)"""
+        raise NotImplementedError
+
+
+class TorchBackend(Backend):
+    name = 'torch'
+
+    def __init__(self, weights, device, data=None):
+        self.model = DetectMultiBackend(weights, device=device, data=data)
+        self.names = self.model.names
+        self.stride = self.model.stride
+        self.fp16 = self.model.fp16
+        self.dynamic = self.model.pt
+        self.path = weights
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.model(batch)
+
+
+class OnnxBackend(Backend):
+    name = 'onnx'
+
+    def __init__(self, path, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        self.input_name = self.session.get_inputs()[0].name
+        # dynamic axes are exported as named dimensions instead of sizes
+        self.dynamic = any(isinstance(dim, str) for dim in self.session.get_inputs()[0].shape[2:])
+
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.stride = int(meta['stride'])
+        self.names = ast.literal_eval(meta['names'])
+        self.path = path
+
+    def __call__(self, batch):
+        output = self.session.run(None, {self.input_name: batch.cpu().numpy().astype(np.float32, copy=False)})[0]
+        return torch.from_numpy(output)
+
+
+def onnx_path(weights, imgsz=640, int8=False):
+    """Path of the ONNX export of the weights, per imgsz as a static export only runs on its own input size"""
+    return f'{os.path.splitext(weights)[0]}-{imgsz}' + ('-int8.onnx' if int8 else '.onnx')
+
+
+def export_onnx(weights, output, imgsz=640, opset=12, dynamic=True):
+    """Exports a PyTorch checkpoint to ONNX, with its stride and class names in the model metadata"""
+    import onnx
+    from models.experimental import attempt_load
+    from models.yolo import Detect
+
+    start = time.perf_counter()
+    model = attempt_load(weights, device=torch.device('cpu'), inplace=True, fuse=True)
+    for m in model.modules():
+        if isinstance(m, Detect):
+            # export the grid computation for any input shape, and the output as a single tensor
+            m.inplace = False
+            m.dynamic = dynamic
+            m.export = True
+
+    im = torch.zeros(1, 3, imgsz, imgsz)
+    for _ in range(2):
+        model(im)  # dry runs, build the grids
+
+    # the TorchScript exporter, recent torch versions default to the dynamo one which can't trace the fused model
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        model, im, output,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=['images'],
+        output_names=['output0'],
+        dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'}, 'output0': {0: 'batch', 1: 'anchors'}}
+        if dynamic else {'images': {0: 'batch'}, 'output0': {0: 'batch'}},
+        **options,
+    )
+
+    model_onnx = onnx.load(output)
+    onnx.checker.check_model(model_onnx)
+    set_metadata(model_onnx, {'stride': int(max(model.stride)), 'names': model.names})
+    onnx.save(model_onnx, output)
+
+    stride = int(max(model.stride))
+    if dynamic and not runs(output, (1, 3, imgsz - stride, imgsz)):
+        # some torch versions trace the grids of the Detect layer with the sizes of the example input,
+        # the static export is padded to imgsz x imgsz by the engine instead
+        logger.warning(f'onnx export: the dynamic export of {weights} fails on other input sizes, exporting it static')
+        return export_onnx(weights, output, imgsz=imgsz, opset=opset, dynamic=False)
+    logger.info(f'onnx export: {weights} -> {output} in {time.perf_counter() - start:.1f}s')
+    return output
+
+
+def runs(path, shape):
+    """True if the ONNX model at path runs on an input of shape"""
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    try:
+        session.run(None, {session.get_inputs()[0].name: np.zeros(shape, dtype=np.float32)})
+    except onnxruntime.capi.onnxruntime_pybind11_state.Fail:
+        return False
+    return True
+
+
+def quantize_onnx(path, output):
+    """
+    Quantizes the weights of an ONNX model to INT8 (dynamic quantization, activations are quantized at runtime)
+    """
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    start = time.perf_counter()
+    quantize_dynamic(path, output, weight_type=QuantType.QUInt8)
+
+    # the quantized model doesn't keep the metadata of the original one
+    metadata = {p.key: p.value for p in onnx.load(path).metadata_props}
+    model_int8 = onnx.load(output)
+    set_metadata(model_int8, metadata)
+    onnx.save(model_int8, output)
+    logger.info(f'onnx int8 quantization: {path} -> {output} in {time.perf_counter() - start:.1f}s')
+    return output
+
+
+def set_metadata(model_onnx, metadata):
+    del model_onnx.metadata_props[:]
+    for key, value in metadata.items():
+        meta = model_onnx.metadata_props.add()
+        meta.key, meta.value = key, str(value)
+
+
+def create_backend(name, weights, device, data=None, imgsz=640, int8=False, threads=0):
+    """
+    Creates the backend called name to run the weights.
+    The ONNX backend runs the export of the weights, created (and quantized if int8) when missing.
+    """
+    if name == 'torch':
+        return TorchBackend(weights, device, data=data)
+    if name != 'onnx':
+        raise ValueError(f'unknown inference backend {name}, expected one of {BACKENDS}')
+    if device.type != 'cpu':
+        logger.warning(f'onnx backend: runs on the CPU, device {device} is ignored')
+
+    path = onnx_path(weights, imgsz, int8)
+    if not os.path.exists(path):
+        fp32_path = onnx_path(weights, imgsz)
+        if not os.path.exists(fp32_path):
+            export_onnx(weights, fp32_path, imgsz=imgsz)
+        if int8:
+            quantize_onnx(fp32_path, path)
+    return OnnxBackend(path, threads=threads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports PyTorch weights for the onnx backend')
+    parser.add_argument('weights')
+    parser.add_argument('--imgsz', type=int, default=640, help='the YOLO_IMG_SIZE the export is run with')
+    parser.add_argument('--int8', action='store_true', help='also write the INT8 quantized model')
+    args = parser.parse_args()
+
+    export_onnx(args.weights, onnx_path(args.weights, args.imgsz), imgsz=args.imgsz)
+    if args.int8:
+        quantize_onnx(onnx_path(args.weights, args.imgsz), onnx_path(args.weights, args.imgsz, int8=True))
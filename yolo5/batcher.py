@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+class MicroBatcher:
+    """
+    Collects concurrent predict requests and runs them through the engine as a single batch.
+    A batch is dispatched once it holds max_batch_size images, or max_wait_ms after its first image arrived.
+    """
+
+    def __init__(self, engine, max_batch_size=8, max_wait_ms=10, wait_window=1000):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._batch_sizes = Counter()
+        self._waits = deque(maxlen=wait_window)
+        self._stats_lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, img):
+        """Queues a single BGR image, the returned future resolves to (Detections, timings)"""
+        future = Future()
+        self._queue.put((img, future, time.perf_counter()))
+        return future
+
+    def predict(self, img, timeout=None):
+        return self.submit(img).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            waits = [(started - enqueued) * 1000 for _, _, enqueued in batch]
+
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                self._waits.extend(waits)
+
+            try:
+                detections, timings = self.engine.predict([img for img, _, _ in batch])
+            except Exception as e:
+                logger.exception(f'micro-batcher: batch of {len(batch)} failed')
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for det, wait, (_, future, _) in zip(detections, waits, batch):
+                future.set_result((det, dict(timings, queue_wait=wait, batch_size=len(batch))))
+
+    def stats(self):
+        with self._stats_lock:
+            waits = sorted(self._waits)
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size_histogram': batch_sizes,
+            'wait_ms': {
+                'avg': sum(waits) / len(waits) if waits else 0.0,
+                'p50': waits[len(waits) // 2] if waits else 0.0,
+                'max': waits[-1] if waits else 0.0,
+            },
+        }
@@ -0,0 +1,119 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import pymongo
+from loguru import logger
+from pymongo.errors import PyMongoError
+
+from mongo_writer import BufferedMongoWriter
+
+
+def cache_key(content_md5, version):
+    """
+    Cache key of an image: the MD5 of its content (which is also its S3 ETag for non multipart uploads)
+    combined with the model/config version that produced the prediction
+    """
+    return hashlib.sha256(f'{version}:{content_md5}'.encode()).hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of prediction summaries.
+    The first tier is an in-memory LRU, the optional second tier is a MongoDB collection whose
+    documents are evicted by a TTL index, so it can be shared by all yolo5 replicas.
+    The MongoDB tier is kept off the prediction path: lookups give up after lookup_timeout_ms, and after a failed
+    one (e.g. during a replica set election) the tier is skipped for retry_interval seconds,
+    new predictions are written behind by a BufferedMongoWriter.
+    """
+
+    def __init__(self, max_size=1024, collection=None, ttl_seconds=7 * 24 * 3600, lookup_timeout_ms=200,
+                 retry_interval=30.0):
+        self.max_size = max_size
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.lookup_timeout_ms = lookup_timeout_ms
+        self.retry_interval = retry_interval
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'mongo_hits': 0, 'misses': 0, 'evictions': 0, 'mongo_errors': 0,
+                       'mongo_skipped': 0}
+        # monotonic time until which the MongoDB tier is not looked up after a failure
+        self._mongo_down_until = 0
+
+        self._writer = BufferedMongoWriter(collection) if collection is not None else None
+
+    def create_indexes(self):
+        if self.collection is None:
+            return
+        try:
+            self.collection.create_index('created_at', expireAfterSeconds=self.ttl_seconds)
+        except PyMongoError as e:
+            logger.error(f'prediction cache: could not create the TTL index: {e}')
+
+    def get(self, key):
+        with self._lock:
+            summary = self._lru.get(key)
+            if summary is not None:
+                self._lru.move_to_end(key)
+                self._stats['hits'] += 1
+                return summary
+
+        if self._mongo_available():
+            try:
+                # bounds the server selection too, not only the query
+                with pymongo.timeout(self.lookup_timeout_ms / 1000):
+                    doc = self.collection.find_one({'_id': key})
+            except PyMongoError as e:
+                logger.error(f'prediction cache: lookup failed, skipping MongoDB for {self.retry_interval}s: {e}')
+                with self._lock:
+                    self._stats['mongo_errors'] += 1
+                    self._mongo_down_until = time.monotonic() + self.retry_interval
+                doc = None
+
+            if doc is not None:
+                self._put_local(key, doc['summary'])
+                with self._lock:
+                    self._stats['hits'] += 1
+                    self._stats['mongo_hits'] += 1
+                return doc['summary']
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def _mongo_available(self):
+        if self.collection is None:
+            return False
+        with self._lock:
+            if time.monotonic() < self._mongo_down_until:
+                self._stats['mongo_skipped'] += 1
+                return False
+        return True
+
+    def put(self, key, summary):
+        self._put_local(key, summary)
+
+        if self._writer is not None:
+            # the key is the hash of the image content, an image already stored has the same summary,
+            # so the writer skipping the duplicates is enough
+            self._writer.add({'_id': key, 'summary': summary, 'created_at': datetime.datetime.utcnow()})
+
+    def _put_local(self, key, summary):
+        with self._lock:
+            self._lru[key] = summary
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._lru), max_size=self.max_size)
+        if self._writer is not None:
+            stats['mongo_writer'] = self._writer.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
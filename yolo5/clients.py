@@ -0,0 +1,105 @@
+# Shared by the polybot and yolo5 services, the two copies of this module are kept identical on purpose:
+# get_http_session() is yolo5's (requests), create_aiohttp_session() is polybot's.
+import os
+import threading
+
+import boto3
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pool and retry policy, shared by all the S3 and HTTP calls of the service
+MAX_POOL_SIZE = int(os.environ.get('MAX_POOL_SIZE', 20))
+MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('RETRY_BACKOFF_FACTOR', 0.3))
+
+_lock = threading.Lock()
+_s3_client = None
+_http_session = None
+_stats = {'s3_clients_created': 0, 's3_requests': 0, 'aiohttp_requests': 0, 'aiohttp_connections_opened': 0,
+          'aiohttp_connections_reused': 0}
+
+
+def _count_s3_request(**kwargs):
+    with _lock:
+        _stats['s3_requests'] += 1
+
+
+def get_s3_client():
+    """
+    The S3 client of the process, created on first use.
+    boto3 clients are thread safe, so it is shared by all threads and keeps its connections alive between requests.
+    """
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config=Config(
+                max_pool_connections=MAX_POOL_SIZE,
+                retries={'max_attempts': MAX_RETRIES, 'mode': 'standard'},
+                tcp_keepalive=True,
+            ))
+            _s3_client.meta.events.register('before-send.s3', _count_s3_request)
+            _stats['s3_clients_created'] += 1
+        return _s3_client
+
+
+def get_http_session():
+    """
+    The requests session of the process, created on first use.
+    Connections are pooled per host and kept alive, failed connections are retried with exponential backoff.
+    Only idempotent requests are retried after a bad gateway/unavailable response.
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=MAX_POOL_SIZE, pool_maxsize=MAX_POOL_SIZE, max_retries=retry)
+            _http_session = requests.Session()
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+        return _http_session
+
+
+def create_aiohttp_session():
+    """
+    An aiohttp session for the asyncio services, pooled like the requests session. Its requests and
+    connections are counted in connection_stats(). It must be created, used and closed inside the event loop.
+    """
+    import aiohttp
+
+    def counter(name):
+        async def count(session, context, params):
+            with _lock:
+                _stats[name] += 1
+        return count
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(counter('aiohttp_requests'))
+    trace.on_connection_create_end.append(counter('aiohttp_connections_opened'))
+    trace.on_connection_reuseconn.append(counter('aiohttp_connections_reused'))
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_POOL_SIZE), trace_configs=[trace])
+
+
+def connection_stats():
+    """Counts of the pooled HTTP connections opened versus the requests they served"""
+    with _lock:
+        stats = dict(_stats)
+        session = _http_session
+
+    http_requests = http_connections = 0
+    if session is not None:
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    http_requests += pool.num_requests
+                    http_connections += pool.num_connections
+
+    stats.update({
+        'http_requests': http_requests,
+        'http_connections_opened': http_connections,
+        'http_connections_reused': max(http_requests - http_connections, 0),
+    })
+    return stats
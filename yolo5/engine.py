@@ -0,0 +1,224 @@
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from loguru import logger
+from torchvision.ops import batched_nms
+
+from backends import create_backend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_boxes
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+
+
+@dataclass
+class Detections:
+    """
+    Detections of a single image.
+    Boxes are in pixel coordinates of the original image, one row per detected object.
+    """
+    xyxy: np.ndarray
+    conf: np.ndarray
+    cls: np.ndarray
+    shape: tuple
+
+    def __len__(self):
+        return len(self.cls)
+
+    def xywhn(self):
+        """Boxes as normalized (cx, cy, width, height), the format yolov5 writes to labels/*.txt"""
+        height, width = self.shape
+        x1, y1, x2, y2 = self.xyxy.T
+        return np.stack([(x1 + x2) / 2 / width, (y1 + y2) / 2 / height, (x2 - x1) / width, (y2 - y1) / height], axis=1)
+
+    def to_columns(self, names):
+        """
+        The detections as columns (see summary.py), most confident first, with the classes as indexes in the list
+        of the class names found. Boxes are normalized (cx, cy, width, height), like the yolov5 labels/*.txt.
+        """
+        order = np.argsort(-self.conf, kind='stable')
+        found, cls = np.unique(self.cls[order], return_inverse=True)
+        # rounded in float64, float32 values would be serialized with all their digits
+        cx, cy, width, height = self.xywhn()[order].astype(float).round(5).T
+        return {
+            'names': [names[int(c)] for c in found],
+            'class': cls.tolist(),
+            'conf': self.conf[order].astype(float).round(4).tolist(),
+            'cx': cx.tolist(),
+            'cy': cy.tolist(),
+            'width': width.tolist(),
+            'height': height.tolist(),
+        }
+
+
+class InferenceEngine:
+    """
+    Keeps a YOLOv5 model resident in memory.
+    The weights are loaded and warmed up once, then every call to predict() runs on in-memory images.
+    The network is run by the backend called backend (see backends.py), int8 and threads apply to onnx only.
+    """
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, conf_thres=0.25,
+                 iou_thres=0.45, max_det=1000, device='cpu', warmup_runs=2, backend='torch', int8=False, threads=0):
+        start = time.perf_counter()
+
+        self.device = select_device(device)
+        self.backend = create_backend(backend, weights, self.device, data=data, imgsz=imgsz, int8=int8,
+                                      threads=threads)
+        self.stride = self.backend.stride
+        self.names = self.backend.names
+        self.imgsz = check_img_size((imgsz, imgsz), s=self.stride)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+
+        # identifies the model and the settings that affect the detections, used to key cached predictions
+        with open(self.backend.path, 'rb') as f:
+            weights_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+        self.version = f'{weights_hash}-{self.imgsz[0]}-{conf_thres}-{iou_thres}-{max_det}'
+
+        # a single model instance is shared by all Flask threads
+        self._lock = threading.Lock()
+
+        self.warmup(runs=warmup_runs)
+
+        self.load_time = time.perf_counter() - start
+        logger.info(f'inference engine: loaded {self.backend.path} ({self.backend.name} backend) on {self.device} '
+                    f'in {self.load_time:.2f}s')
+
+    def warmup(self, images=None, runs=2):
+        """
+        Runs a few predictions, so the first requests don't pay for the lazy initializations of the backend
+        (DetectMultiBackend.warmup() is a no-op on CPU).
+        :param images: sample BGR images, predicted alone (rectangular inference) then as a batch, like the requests
+            are, which also runs the NMS on real detections. Dummy forward passes of the input size if not given
+        """
+        if not images:
+            dummy = torch.zeros((1, 3, *self.imgsz), device=self.device)
+            dummy = dummy.half() if self.backend.fp16 else dummy
+        for _ in range(runs):
+            if images:
+                self.predict(images[:1])
+                self.predict(images)
+            else:
+                self.backend(dummy)
+
+    def preprocess(self, im0, auto=False):
+        """Letterbox a BGR HWC image and convert it to a contiguous RGB CHW array"""
+        im = letterbox(im0, self.imgsz, stride=self.stride, auto=auto)[0]
+        im = im.transpose((2, 0, 1))[::-1]
+        return np.ascontiguousarray(im)
+
+    def predict(self, images):
+        """
+        Runs inference on a list of BGR images (as returned by cv2.imdecode / cv2.imread).
+        :return: tuple of (list of Detections, one per image, dict of per-stage timings in milliseconds)
+        """
+        # rectangular (minimal padding) inference is only possible when there is a single image in the batch
+        auto = len(images) == 1 and self.backend.dynamic
+        pred, timings = self._detect(images, auto=auto)
+
+        results = []
+        for det, im0 in zip(pred, images):
+            det = det.cpu().numpy()
+            results.append(Detections(det[:, :4].round(), det[:, 4], det[:, 5].astype(int), im0.shape[:2]))
+        return results, timings
+
+    def predict_tiled(self, im0, overlap=0.2, max_batch_size=8):
+        """
+        Runs inference on a large BGR image split into overlapping tiles of the model input size,
+        so small objects are not lost by downscaling the whole image to the input size.
+        The tiles are views of the image, only max_batch_size of them are converted to the network input at a time.
+        The image is also predicted as a whole, for the objects larger than a tile.
+        Detections cut by an inner tile border are dropped (the overlap keeps the objects smaller than it whole in
+        a neighbour tile), then the detections of all the tiles are merged with a global NMS.
+        :return: tuple of (Detections, dict of per-stage timings in milliseconds)
+        """
+        height, width = im0.shape[:2]
+        tile_h, tile_w = self.imgsz
+        if height <= tile_h and width <= tile_w:
+            results, timings = self.predict([im0])
+            return results[0], dict(timings, tiles=1)
+
+        origins = [(y, x) for y in tile_origins(height, tile_h, overlap) for x in tile_origins(width, tile_w, overlap)]
+
+        # the whole image first, as a single image batch
+        merged, timings = self._detect([im0], auto=self.backend.dynamic)
+        timings['tiles'] = len(origins)
+        for i in range(0, len(origins), max_batch_size):
+            chunk = origins[i:i + max_batch_size]
+            tiles = [im0[y:y + tile_h, x:x + tile_w] for y, x in chunk]
+            pred, chunk_timings = self._detect(tiles)
+            for det, (y, x), tile in zip(pred, chunk, tiles):
+                det = det[~cut_by_tile_border(det, x, y, tile.shape, im0.shape)]
+                det[:, [0, 2]] += x
+                det[:, [1, 3]] += y
+                merged.append(det)
+            for stage, ms in chunk_timings.items():
+                timings[stage] += ms
+
+        t0 = time.perf_counter()
+        det = torch.cat(merged)
+        keep = batched_nms(det[:, :4], det[:, 4], det[:, 5], self.iou_thres)[:self.max_det]
+        det = det[keep].cpu().numpy()
+        timings['nms'] += (time.perf_counter() - t0) * 1000
+
+        return Detections(det[:, :4].round(), det[:, 4], det[:, 5].astype(int), (height, width)), timings
+
+    def _detect(self, images, auto=False):
+        """
+        Runs the network and the NMS on a batch of images.
+        :return: tuple of (list of (x1, y1, x2, y2, conf, cls) tensors in the pixel coordinates of each image,
+            dict of per-stage timings in milliseconds)
+        """
+        t0 = time.perf_counter()
+
+        batch = torch.from_numpy(np.stack([self.preprocess(im0, auto=auto) for im0 in images])).to(self.device)
+        batch = batch.half() if self.backend.fp16 else batch.float()
+        batch /= 255
+
+        t1 = time.perf_counter()
+        with self._lock:
+            pred = self.backend(batch)
+
+        t2 = time.perf_counter()
+        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+        for det, im0 in zip(pred, images):
+            det[:, :4] = scale_boxes(batch.shape[2:], det[:, :4], im0.shape)
+
+        t3 = time.perf_counter()
+        timings = {
+            'preprocess': (t1 - t0) * 1000,
+            'inference': (t2 - t1) * 1000,
+            'nms': (t3 - t2) * 1000,
+        }
+        return pred, timings
+
+    def annotate(self, im0, detections):
+        """Draws the detected boxes on a copy of the image, like detect.run(save_img=True) does"""
+        annotator = Annotator(im0.copy(), line_width=3, example=str(self.names))
+        for xyxy, conf, c in zip(detections.xyxy, detections.conf, detections.cls):
+            annotator.box_label(xyxy, f'{self.names[int(c)]} {conf:.2f}', color=colors(int(c), True))
+        return annotator.result()
+
+
+def tile_origins(size, tile, overlap):
+    """Start offsets of the tiles along one side, the last tile is aligned to the end of the side"""
+    if size <= tile:
+        return [0]
+    step = max(1, int(tile * (1 - overlap)))
+    return list(range(0, size - tile, step)) + [size - tile]
+
+
+def cut_by_tile_border(det, x, y, tile_shape, image_shape, margin=2):
+    """Mask of the detections of a tile at (x, y) that touch one of its borders inside the image"""
+    tile_h, tile_w = tile_shape[:2]
+    height, width = image_shape[:2]
+    return (((det[:, 0] <= margin) & (x > 0)) |
+            ((det[:, 1] <= margin) & (y > 0)) |
+            ((det[:, 2] >= tile_w - margin) & (x + tile_w < width)) |
+            ((det[:, 3] >= tile_h - margin) & (y + tile_h < height)))
@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import boto3
+
+
+class SQLiteQueueClient:
+    """
+    Local stand-in for an SQS client, backed by an SQLite database.
+    It implements the subset of the boto3 SQS client used by the services (send_message, receive_message and
+    delete_message, with the same arguments and response shapes), with the queue URL acting as the queue name.
+    Messages that are received but not deleted become visible again after their visibility timeout, like in SQS,
+    and the ApproximateReceiveCount attribute counts their receives.
+
+    Use a file path shared by the containers (e.g. on a docker volume) to connect the bot and the yolo5 workers,
+    or ':memory:' to run everything inside a single process.
+    """
+
+    def __init__(self, path=':memory:', poll_interval=0.1):
+        self.poll_interval = poll_interval
+        # one connection shared by the threads of this process, other processes are serialized by sqlite's own locking
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                queue TEXT NOT NULL,
+                body TEXT NOT NULL,
+                visible_at REAL NOT NULL,
+                receipt TEXT,
+                receive_count INTEGER NOT NULL DEFAULT 0
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_visible ON messages (queue, visible_at)')
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO messages (id, queue, body, visible_at) VALUES (?, ?, ?, ?)',
+                (message_id, QueueUrl, MessageBody, time.time() + DelaySeconds),
+            )
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30,
+                        AttributeNames=()):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            messages = self._receive(QueueUrl, MaxNumberOfMessages, VisibilityTimeout, AttributeNames)
+            if messages or time.time() >= deadline:
+                return {'Messages': messages} if messages else {}
+            time.sleep(self.poll_interval)
+
+    def _receive(self, queue_url, max_messages, visibility_timeout, attribute_names=()):
+        now = time.time()
+        messages = []
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(
+                    'SELECT id, body, receive_count FROM messages WHERE queue = ? AND visible_at <= ? '
+                    'ORDER BY rowid LIMIT ?',
+                    (queue_url, now, max_messages),
+                ).fetchall()
+
+                for message_id, body, receive_count in rows:
+                    receipt = str(uuid.uuid4())
+                    self._db.execute(
+                        'UPDATE messages SET visible_at = ?, receipt = ?, receive_count = receive_count + 1 WHERE id = ?',
+                        (now + visibility_timeout, receipt, message_id),
+                    )
+                    message = {'MessageId': message_id, 'ReceiptHandle': receipt, 'Body': body}
+                    if 'ApproximateReceiveCount' in attribute_names or 'All' in attribute_names:
+                        # a string, like in SQS
+                        message['Attributes'] = {'ApproximateReceiveCount': str(receive_count + 1)}
+                    messages.append(message)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return messages
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._lock:
+            self._db.execute('DELETE FROM messages WHERE queue = ? AND receipt = ?', (QueueUrl, ReceiptHandle))
+        return {}
+
+
+def get_queue_client():
+    """
+    Queue client selected by the QUEUE_BACKEND environment variable:
+    'sqs' (default) for Amazon SQS, 'sqlite' for the local stand-in stored at QUEUE_SQLITE_PATH
+    """
+    backend = os.environ.get('QUEUE_BACKEND', 'sqs')
+    if backend == 'sqs':
+        return boto3.client('sqs')
+    if backend == 'sqlite':
+        return SQLiteQueueClient(os.environ.get('QUEUE_SQLITE_PATH', ':memory:'))
+    raise ValueError(f'unknown QUEUE_BACKEND {backend}')
@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
+
+
+class BufferedMongoWriter:
+    """
+    Write-behind persistence of documents to a MongoDB collection.
+    add() only appends the document to a bounded buffer, a background thread flushes the buffer with insert_many
+    once it holds flush_size documents or flush_interval seconds after the previous flush.
+    If MongoDB is slow or unavailable (e.g. during a replica set election) the failed batch is retried with backoff,
+    and once the buffer is full new documents are dropped and counted, instead of blocking the caller.
+
+    Any object with the pymongo Collection interface can be used, e.g. a mongomock collection in tests.
+    """
+
+    def __init__(self, collection, flush_size=100, flush_interval=1.0, max_buffer=10000, put_timeout=0.05,
+                 write_concern=None, max_backoff=30.0):
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_backoff = max_backoff
+
+        self._buffer = queue.Queue(maxsize=max_buffer)
+        self._lock = threading.Lock()
+        self._stats = {'written': 0, 'dropped': 0, 'rejected': 0, 'failed_flushes': 0, 'flushes': 0}
+        self._stop = threading.Event()
+
+        self._worker = threading.Thread(target=self._run, name='mongo-writer', daemon=True)
+        self._worker.start()
+
+    def create_indexes(self):
+        try:
+            self.collection.create_index('prediction_id', unique=True)
+            self.collection.create_index([('chat_id', ASCENDING), ('time', DESCENDING)])
+            self.collection.create_index([('time', DESCENDING)])
+        except PyMongoError as e:
+            logger.error(f'mongo writer: could not create indexes: {e}')
+
+    def add(self, doc):
+        """
+        Queues a copy of doc for insertion (insert_many adds an _id to the documents it inserts).
+        :return: False if the buffer is full and the document was dropped, else True
+        """
+        try:
+            self._buffer.put(dict(doc), timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            logger.warning(f'mongo writer: buffer full, dropped document {doc.get("prediction_id")}')
+            return False
+        return True
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                doc = self._buffer.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if doc is None:
+                # woken up by close()
+                break
+            batch.append(doc)
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self._buffer.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        backoff = 0.5
+        while True:
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                with self._lock:
+                    self._stats['written'] += len(batch)
+                    self._stats['flushes'] += 1
+                return
+            except BulkWriteError as e:
+                # not retried: duplicates were written by a previous attempt, other write errors would fail again
+                errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+                if errors:
+                    logger.error(f'mongo writer: {len(errors)} documents rejected: {errors[0].get("errmsg")}')
+                with self._lock:
+                    self._stats['written'] += e.details.get('nInserted', 0)
+                    self._stats['rejected'] += len(errors)
+                    self._stats['flushes'] += 1
+                return
+            except PyMongoError as e:
+                with self._lock:
+                    self._stats['failed_flushes'] += 1
+                if self._stop.is_set():
+                    logger.error(f'mongo writer: giving up on {len(batch)} documents on shutdown: {e}')
+                    return
+                logger.warning(f'mongo writer: flush of {len(batch)} documents failed, retrying in {backoff}s: {e}')
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, buffered=self._buffer.qsize())
+
+    def close(self):
+        """Flushes the buffered documents and stops the writer thread"""
+        self._stop.set()
+        # the writer may be waiting for documents up to flush_interval
+        self._buffer.put(None)
+        self._worker.join()
+
+
+def parse_write_concern(w, wtimeout_ms=None, journal=None):
+    """Builds a WriteConcern from configuration strings, w is a number of nodes or a tag like 'majority'"""
+    return WriteConcern(w=int(w) if str(w).isdigit() else w, wtimeout=wtimeout_ms, j=journal)
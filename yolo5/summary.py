@@ -0,0 +1,88 @@
+"""
+Views of the detections returned to the clients.
+
+The detections of a prediction are kept columnar (see Detections.to_columns), e.g. for two persons and a car:
+
+    {"names": ["person", "car"], "class": [0, 0, 1], "conf": [0.91, 0.62, 0.88],
+     "cx": [...], "cy": [...], "width": [...], "height": [...]}
+
+"class" indexes "names", the classes found in the image, and the detections are sorted by decreasing confidence.
+The cached and stored predictions keep all of them, the confidence threshold and top-k of a request are applied
+when it is answered, along with the per-class summary of the selected detections:
+
+    {"person": {"count": 2, "max_conf": 0.91, "mean_conf": 0.765}, "car": {"count": 1, ...}}
+"""
+import numpy as np
+
+COLUMNS = ('class', 'conf', 'cx', 'cy', 'width', 'height')
+
+
+def select(detections, conf_thres=None, top_k=None):
+    """The detections with a confidence of at least conf_thres, at most the top_k most confident ones"""
+    conf = np.asarray(detections['conf'])
+    # sorted by decreasing confidence, so the selection is always a prefix
+    count = len(conf) if conf_thres is None else int(np.count_nonzero(conf >= conf_thres))
+    count = count if top_k is None else min(count, top_k)
+    if count == len(conf):
+        return detections
+    return dict(detections, **{column: detections[column][:count] for column in COLUMNS})
+
+
+def summarize(detections):
+    """Number of detections, max and mean confidence of every class, the most frequent classes first"""
+    cls = np.asarray(detections['class'], dtype=int)
+    conf = np.asarray(detections['conf'], dtype=float)
+    names = detections['names']
+    counts = np.bincount(cls, minlength=len(names))
+    conf_sums = np.bincount(cls, weights=conf, minlength=len(names))
+    conf_max = np.zeros(len(names))
+    np.maximum.at(conf_max, cls, conf)
+
+    return {names[i]: {'count': int(counts[i]),
+                       'max_conf': round(float(conf_max[i]), 3),
+                       'mean_conf': round(float(conf_sums[i] / counts[i]), 3)}
+            for i in sorted(np.flatnonzero(counts), key=lambda i: (-counts[i], names[i]))}
+
+
+def prediction_view(prediction, conf_thres=None, top_k=None, boxes=True):
+    """
+    The prediction as returned to a client: its detections selected by conf_thres and top_k, and their summary.
+    :param boxes: False to return the summary only, without the detections
+    """
+    detections = select(prediction['detections'], conf_thres, top_k)
+    view = dict(prediction, summary=summarize(detections))
+    if boxes:
+        view['detections'] = detections
+    else:
+        del view['detections']
+    return view
+
+
+def parse_options(args):
+    """
+    The conf, top-k and boxes options of a request, given as query parameters (conf, topK, boxes)
+    or JSON fields (conf, top_k, boxes).
+    :return: dict of prediction_view() keyword arguments
+    :raise ValueError: if an option is invalid
+    """
+    options = {}
+    conf = args.get('conf')
+    if conf is not None:
+        try:
+            options['conf_thres'] = float(conf)
+        except (TypeError, ValueError):
+            raise ValueError(f'conf must be a number, got {conf}')
+        if not 0 <= options['conf_thres'] <= 1:
+            raise ValueError(f'conf must be between 0 and 1, got {conf}')
+    top_k = args.get('topK', args.get('top_k'))
+    if top_k is not None:
+        try:
+            options['top_k'] = int(top_k)
+        except (TypeError, ValueError):
+            raise ValueError(f'topK must be a whole number, got {top_k}')
+        if options['top_k'] < 0:
+            raise ValueError(f'topK must be positive, got {top_k}')
+    boxes = args.get('boxes')
+    if boxes is not None:
+        options['boxes'] = boxes if isinstance(boxes, bool) else str(boxes).lower() in ('1', 'true')
+    return options
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, RateLimiter, Rejected
+
+
+class Blocked:
+    """A request admitted by the controller, that holds its slot until released"""
+
+    def __init__(self, controller, client=None, timeout=None):
+        self.admitted = threading.Event()
+        self.release = threading.Event()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(controller, client, timeout), daemon=True)
+        self._thread.start()
+
+    def _run(self, controller, client, timeout):
+        try:
+            with controller.admit(client, timeout):
+                self.admitted.set()
+                self.release.wait(5)
+        except Rejected as e:
+            self.error = e
+
+    def join(self):
+        self.release.set()
+        self._thread.join(5)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.005)
+
+
+def test_rate_limiter_allows_bursts():
+    limiter = RateLimiter(rate=1, burst=3)
+    assert [limiter.take('chat') for _ in range(3)] == [0, 0, 0]
+    assert 0 < limiter.take('chat') <= 1
+    assert limiter.take('other chat') == 0
+
+
+def test_rate_limiter_forgets_the_oldest_clients():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.take(client)
+    assert limiter.take('a') == 0
+    assert limiter.take('c') > 0
+
+
+def test_rate_limited_requests_are_rejected_with_429():
+    controller = AdmissionController(rate_limiter=RateLimiter(rate=1, burst=1))
+    with controller.admit('chat'):
+        pass
+    with pytest.raises(Rejected) as e:
+        with controller.admit('chat'):
+            pass
+    assert e.value.status == 429
+    assert e.value.retry_after > 0
+    # not rate limited without a client
+    with controller.admit():
+        pass
+    assert controller.stats()['rate_limited'] == 1
+
+
+def test_requests_beyond_the_concurrency_limit_wait_in_order():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    first = Blocked(controller)
+    first.admitted.wait(2)
+    second = Blocked(controller)
+    wait_for(lambda: controller.stats()['waiting'] == 1)
+    third = Blocked(controller)
+    wait_for(lambda: controller.stats()['waiting'] == 2)
+    assert not second.admitted.is_set()
+
+    first.join()
+    second.admitted.wait(2)
+    assert not third.admitted.is_set()
+    second.join()
+    third.admitted.wait(2)
+    third.join()
+    assert controller.stats()['admitted'] == 3
+
+
+def test_requests_beyond_the_queue_are_rejected_with_503():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    running = Blocked(controller)
+    running.admitted.wait(2)
+    queued = Blocked(controller)
+    wait_for(lambda: controller.stats()['waiting'] == 1)
+
+    with pytest.raises(Rejected) as e:
+        with controller.admit():
+            pass
+    assert (e.value.status, e.value.reason) == (503, 'queue_full')
+    running.join()
+    queued.join()
+    assert queued.error is None
+
+
+def test_requests_that_cant_make_their_deadline_are_rejected():
+    controller = AdmissionController(max_concurrent=1, service_time=1.0)
+    running = Blocked(controller)
+    running.admitted.wait(2)
+
+    # the estimated wait and service time (2s) don't fit in 1.5s
+    with pytest.raises(Rejected) as e:
+        with controller.admit(timeout=1.5):
+            pass
+    assert (e.value.status, e.value.reason) == (503, 'deadline')
+    running.join()
+
+
+def test_requests_that_wait_past_their_timeout_give_up():
+    controller = AdmissionController(max_concurrent=1, service_time=0.01)
+    running = Blocked(controller)
+    running.admitted.wait(2)
+
+    with pytest.raises(Rejected) as e:
+        with controller.admit(timeout=0.1):
+            pass
+    assert e.value.reason == 'timeout'
+    assert controller.stats()['waiting'] == 0
+    running.join()
+
+
+def test_service_time_is_a_moving_average():
+    controller = AdmissionController(service_time=1.0, smoothing=0.5)
+    with controller.admit():
+        pass
+    assert controller.service_time == pytest.approx(0.5, abs=0.01)
+    assert controller.estimated_wait(3) == pytest.approx(4 * controller.service_time / controller.max_concurrent)
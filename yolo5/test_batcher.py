@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from batcher import MicroBatcher
+
+
+class RecordingEngine:
+    """Engine whose detections are the images themselves, it records the size of every batch"""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def predict(self, imgs):
+        self.started.set()
+        self.release.wait(5)
+        self.batch_sizes.append(len(imgs))
+        if any(img is None for img in imgs):
+            raise ValueError('bad image')
+        return list(imgs), {'inference': 1.0}
+
+
+def test_concurrent_requests_share_a_batch():
+    engine = RecordingEngine()
+    engine.release.clear()
+    batcher = MicroBatcher(engine, max_batch_size=4, max_wait_ms=50)
+    # the first image is dispatched alone while the engine is blocked, the next ones queue up behind it
+    first = batcher.submit('img-0')
+    assert engine.started.wait(2)
+    futures = [batcher.submit(f'img-{i}') for i in range(1, 9)]
+    engine.release.set()
+
+    assert first.result(timeout=2)[0] == 'img-0'
+    for i, future in enumerate(futures, start=1):
+        det, timings = future.result(timeout=2)
+        assert det == f'img-{i}'
+        assert timings['inference'] == 1.0 and timings['batch_size'] == 4
+    assert engine.batch_sizes == [1, 4, 4]
+    assert batcher.stats()['batch_size_histogram'] == {1: 1, 4: 2}
+
+
+def test_dispatches_partial_batches_after_max_wait():
+    engine = RecordingEngine()
+    batcher = MicroBatcher(engine, max_batch_size=8, max_wait_ms=1)
+    det, timings = batcher.predict('img', timeout=2)
+    assert det == 'img' and timings['batch_size'] == 1
+    assert engine.batch_sizes == [1]
+
+
+def test_a_failed_batch_fails_each_caller():
+    engine = RecordingEngine()
+    engine.release.clear()
+    batcher = MicroBatcher(engine, max_batch_size=2, max_wait_ms=50)
+    batcher.submit('img-0')
+    assert engine.started.wait(2)
+    futures = [batcher.submit('img-1'), batcher.submit(None)]
+    engine.release.set()
+
+    for future in futures:
+        with pytest.raises(ValueError, match='bad image'):
+            future.result(timeout=2)
+    # the batcher keeps serving after a failed batch
+    assert batcher.predict('img-2', timeout=2)[0] == 'img-2'
@@ -0,0 +1,83 @@
+import time
+
+import mongomock
+from pymongo.errors import AutoReconnect
+
+from cache import PredictionCache, cache_key
+
+
+class UnavailableCollection:
+    """Collection of a replica set without a primary"""
+
+    def __init__(self):
+        self.lookups = 0
+
+    def find_one(self, query):
+        self.lookups += 1
+        raise AutoReconnect('no primary')
+
+    def insert_many(self, docs, ordered=True):
+        raise AutoReconnect('no primary')
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.005)
+
+
+def test_cache_key_depends_on_the_content_and_the_version():
+    assert cache_key('md5', 'v1') == cache_key('md5', 'v1')
+    assert cache_key('md5', 'v1') != cache_key('md5', 'v2')
+    assert cache_key('md5', 'v1') != cache_key('other md5', 'v1')
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = PredictionCache(max_size=2)
+    cache.put('a', {'n': 1})
+    cache.put('b', {'n': 2})
+    assert cache.get('a') == {'n': 1}
+    cache.put('c', {'n': 3})
+
+    assert cache.get('b') is None
+    assert cache.get('a') == {'n': 1}
+    assert cache.get('c') == {'n': 3}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (3, 1, 1, 2)
+
+
+def test_mongo_tier_is_shared_by_the_replicas():
+    collection = mongomock.MongoClient().db.prediction_cache
+    cache = PredictionCache(collection=collection)
+    cache.create_indexes()
+    cache.put('a', {'n': 1})
+    wait_for(lambda: collection.count_documents({}) == 1)
+
+    other_replica = PredictionCache(collection=collection)
+    assert other_replica.get('a') == {'n': 1}
+    assert other_replica.stats()['mongo_hits'] == 1
+    # kept in the local tier once found
+    collection.delete_many({})
+    assert other_replica.get('a') == {'n': 1}
+
+
+def test_mongo_tier_is_skipped_after_a_failure():
+    collection = UnavailableCollection()
+    cache = PredictionCache(collection=collection, retry_interval=0.1)
+    assert cache.get('a') is None
+    assert cache.get('b') is None
+    assert collection.lookups == 1
+    assert cache.stats()['mongo_skipped'] == 1
+
+    time.sleep(0.15)
+    assert cache.get('c') is None
+    assert collection.lookups == 2
+
+
+def test_put_doesnt_wait_for_mongo():
+    cache = PredictionCache(collection=UnavailableCollection())
+    start = time.perf_counter()
+    cache.put('a', {'n': 1})
+    assert time.perf_counter() - start < 0.1
+    assert cache.get('a') == {'n': 1}
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from job_queue import SQLiteQueueClient
+
+
+def test_messages_are_received_in_order():
+    client = SQLiteQueueClient()
+    for body in ('a', 'b', 'c'):
+        client.send_message(QueueUrl='jobs', MessageBody=body)
+    messages = client.receive_message(QueueUrl='jobs', MaxNumberOfMessages=2)['Messages']
+    assert [m['Body'] for m in messages] == ['a', 'b']
+    assert client.receive_message(QueueUrl='other') == {}
+
+
+def test_received_messages_are_invisible_until_their_timeout():
+    client = SQLiteQueueClient()
+    client.send_message(QueueUrl='jobs', MessageBody='a')
+    first = client.receive_message(QueueUrl='jobs', VisibilityTimeout=0.2)['Messages'][0]
+    assert client.receive_message(QueueUrl='jobs') == {}
+
+    time.sleep(0.25)
+    again = client.receive_message(QueueUrl='jobs', AttributeNames=['ApproximateReceiveCount'])['Messages'][0]
+    assert again['MessageId'] == first['MessageId']
+    assert again['ReceiptHandle'] != first['ReceiptHandle']
+    assert again['Attributes'] == {'ApproximateReceiveCount': '2'}
+    assert 'Attributes' not in first
+
+
+def test_deleted_messages_are_not_received_again():
+    client = SQLiteQueueClient()
+    client.send_message(QueueUrl='jobs', MessageBody='a')
+    message = client.receive_message(QueueUrl='jobs', VisibilityTimeout=0)['Messages'][0]
+    client.delete_message(QueueUrl='jobs', ReceiptHandle=message['ReceiptHandle'])
+    assert client.receive_message(QueueUrl='jobs') == {}
+
+
+def test_an_old_receipt_doesnt_delete_a_message_received_again():
+    client = SQLiteQueueClient()
+    client.send_message(QueueUrl='jobs', MessageBody='a')
+    old = client.receive_message(QueueUrl='jobs', VisibilityTimeout=0)['Messages'][0]
+    client.receive_message(QueueUrl='jobs', VisibilityTimeout=0)
+    client.delete_message(QueueUrl='jobs', ReceiptHandle=old['ReceiptHandle'])
+    assert client.receive_message(QueueUrl='jobs')['Messages'][0]['Body'] == 'a'
+
+
+def test_delayed_messages():
+    client = SQLiteQueueClient()
+    client.send_message(QueueUrl='jobs', MessageBody='a', DelaySeconds=0.2)
+    assert client.receive_message(QueueUrl='jobs') == {}
+    assert client.receive_message(QueueUrl='jobs', WaitTimeSeconds=1)['Messages'][0]['Body'] == 'a'
+
+
+def test_long_polling_returns_when_a_message_arrives():
+    client = SQLiteQueueClient(poll_interval=0.01)
+    threading.Timer(0.1, client.send_message, kwargs={'QueueUrl': 'jobs', 'MessageBody': 'a'}).start()
+    start = time.monotonic()
+    assert client.receive_message(QueueUrl='jobs', WaitTimeSeconds=5)['Messages'][0]['Body'] == 'a'
+    assert time.monotonic() - start < 1
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import mongomock
+import pytest
+from pymongo.errors import AutoReconnect
+
+from mongo_writer import BufferedMongoWriter
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.predictions
+
+
+class SlowCollection:
+    """Collection whose inserts wait until released, like a primary being elected"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.release = threading.Event()
+        self.failures = 0
+
+    def insert_many(self, docs, ordered=True):
+        if not self.release.wait(5):
+            raise AutoReconnect('no primary')
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('no primary')
+        return self.collection.insert_many(docs, ordered=ordered)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.005)
+
+
+def test_flushes_full_batches_right_away(collection):
+    writer = BufferedMongoWriter(collection, flush_size=3, flush_interval=60)
+    for i in range(6):
+        assert writer.add({'prediction_id': str(i)})
+    wait_for(lambda: writer.stats()['written'] == 6)
+    assert writer.stats()['flushes'] == 2
+    writer.close()
+
+
+def test_flushes_partial_batches_after_the_interval(collection):
+    writer = BufferedMongoWriter(collection, flush_size=100, flush_interval=0.05)
+    writer.add({'prediction_id': 'a'})
+    wait_for(lambda: collection.count_documents({}) == 1)
+    writer.close()
+
+
+def test_flushes_the_buffer_on_close(collection):
+    writer = BufferedMongoWriter(collection, flush_size=100, flush_interval=60)
+    for i in range(5):
+        writer.add({'prediction_id': str(i)})
+    writer.close()
+    assert collection.count_documents({}) == 5
+
+
+def test_add_copies_the_document(collection):
+    writer = BufferedMongoWriter(collection, flush_size=1)
+    doc = {'prediction_id': 'a'}
+    writer.add(doc)
+    writer.close()
+    assert '_id' not in doc
+
+
+def test_drops_documents_once_the_buffer_is_full(collection):
+    slow = SlowCollection(collection)
+    writer = BufferedMongoWriter(slow, flush_size=1, flush_interval=0.01, max_buffer=2, put_timeout=0.01)
+    writer.add({'prediction_id': '0'})
+    # the writer thread is blocked flushing the first document, the next ones fill the buffer
+    wait_for(lambda: writer.stats()['buffered'] == 0)
+    assert writer.add({'prediction_id': '1'}) and writer.add({'prediction_id': '2'})
+    assert not writer.add({'prediction_id': '3'})
+    assert writer.stats()['dropped'] == 1
+
+    slow.release.set()
+    writer.close()
+    assert sorted(doc['prediction_id'] for doc in collection.find()) == ['0', '1', '2']
+
+
+def test_retries_failed_flushes(collection):
+    slow = SlowCollection(collection)
+    slow.release.set()
+    slow.failures = 1
+    writer = BufferedMongoWriter(slow, flush_size=1, flush_interval=0.01)
+    writer.add({'prediction_id': 'a'})
+    wait_for(lambda: writer.stats()['written'] == 1)
+    assert writer.stats()['failed_flushes'] == 1
+    writer.close()
+
+
+def test_ignores_duplicate_keys(collection):
+    collection.create_index('prediction_id', unique=True)
+    collection.insert_one({'prediction_id': 'a'})
+    writer = BufferedMongoWriter(collection, flush_size=2, flush_interval=60)
+    writer.add({'prediction_id': 'a'})
+    writer.add({'prediction_id': 'b'})
+    wait_for(lambda: writer.stats()['flushes'] == 1)
+    writer.close()
+
+    stats = writer.stats()
+    assert (stats['written'], stats['rejected']) == (1, 0)
+    assert collection.count_documents({}) == 2
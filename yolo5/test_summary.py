@@ -0,0 +1,69 @@
+import pytest
+
+from summary import parse_options, prediction_view, select, summarize
+
+# sorted by decreasing confidence, like Detections.to_columns returns them
+DETECTIONS = {
+    'names': ['person', 'car', 'dog'],
+    'class': [0, 1, 0, 2, 1],
+    'conf': [0.91, 0.88, 0.62, 0.4, 0.3],
+    'cx': [10, 20, 30, 40, 50],
+    'cy': [11, 21, 31, 41, 51],
+    'width': [12, 22, 32, 42, 52],
+    'height': [13, 23, 33, 43, 53],
+}
+
+
+def test_select_by_confidence():
+    selected = select(DETECTIONS, conf_thres=0.62)
+    assert selected['class'] == [0, 1, 0]
+    assert selected['cx'] == [10, 20, 30]
+    assert selected['names'] == DETECTIONS['names']
+
+
+def test_select_top_k():
+    assert select(DETECTIONS, top_k=2)['conf'] == [0.91, 0.88]
+    assert select(DETECTIONS, conf_thres=0.9, top_k=2)['conf'] == [0.91]
+    assert select(DETECTIONS, top_k=0)['conf'] == []
+
+
+def test_select_everything():
+    assert select(DETECTIONS) is DETECTIONS
+    assert select(DETECTIONS, conf_thres=0, top_k=10) is DETECTIONS
+
+
+def test_summarize():
+    assert summarize(DETECTIONS) == {
+        'car': {'count': 2, 'max_conf': 0.88, 'mean_conf': 0.59},
+        'person': {'count': 2, 'max_conf': 0.91, 'mean_conf': 0.765},
+        'dog': {'count': 1, 'max_conf': 0.4, 'mean_conf': 0.4},
+    }
+
+
+def test_summarize_nothing():
+    assert summarize(select(DETECTIONS, conf_thres=1)) == {}
+
+
+def test_prediction_view():
+    prediction = {'prediction_id': 'id', 'detections': DETECTIONS}
+    view = prediction_view(prediction, conf_thres=0.8)
+    assert view['detections']['conf'] == [0.91, 0.88]
+    assert list(view['summary']) == ['car', 'person']
+    assert prediction['detections'] is DETECTIONS
+
+    summary_only = prediction_view(prediction, boxes=False)
+    assert 'detections' not in summary_only
+    assert summary_only['prediction_id'] == 'id'
+
+
+def test_parse_options():
+    assert parse_options({}) == {}
+    assert parse_options({'conf': '0.5', 'topK': '3', 'boxes': 'false'}) == \
+        {'conf_thres': 0.5, 'top_k': 3, 'boxes': False}
+    assert parse_options({'conf': 0.25, 'top_k': 1, 'boxes': True}) == {'conf_thres': 0.25, 'top_k': 1, 'boxes': True}
+
+
+@pytest.mark.parametrize('args', [{'conf': 'high'}, {'conf': '1.5'}, {'topK': '2.5'}, {'top_k': -1}])
+def test_parse_options_rejects_invalid_values(args):
+    with pytest.raises(ValueError):
+        parse_options(args)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+engine = pytest.importorskip('engine', reason='the engine needs the yolov5 sources')
+
+
+@pytest.mark.parametrize('size, tile, overlap, expected', [
+    (500, 640, 0.2, [0]),
+    (640, 640, 0.2, [0]),
+    (1000, 640, 0.2, [0, 360]),
+    (2000, 640, 0.2, [0, 512, 1024, 1360]),
+    (1000, 640, 0.0, [0, 360]),
+])
+def test_tile_origins(size, tile, overlap, expected):
+    assert engine.tile_origins(size, tile, overlap) == expected
+
+
+def test_tile_origins_cover_the_side_with_the_overlap():
+    origins = engine.tile_origins(3001, 640, 0.25)
+    assert origins[0] == 0 and origins[-1] + 640 == 3001
+    assert all(0 < b - a <= 480 for a, b in zip(origins, origins[1:]))
+
+
+def test_cut_by_tile_border_keeps_the_image_borders():
+    det = np.array([
+        [0, 10, 50, 60],        # left border of the tile
+        [10, 1, 50, 60],        # top border
+        [600, 10, 639, 60],     # right border
+        [10, 600, 50, 640],     # bottom border
+        [100, 100, 200, 200],   # inside
+    ], dtype=np.float32)
+
+    # a tile in the middle of the image, every border is shared with another tile
+    inner = engine.cut_by_tile_border(det, 300, 300, (640, 640), (2000, 2000))
+    assert inner.tolist() == [True, True, True, True, False]
+
+    # the top left tile, its left and top borders are the image's
+    corner = engine.cut_by_tile_border(det, 0, 0, (640, 640), (2000, 2000))
+    assert corner.tolist() == [False, False, True, True, False]
+
+    # a tile as large as the image is never cut
+    whole = engine.cut_by_tile_border(det, 0, 0, (640, 640), (640, 640))
+    assert not whole.any()
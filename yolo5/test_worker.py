@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from job_queue import SQLiteQueueClient
+from worker import QueueWorker
+
+
+@pytest.fixture
+def client():
+    return SQLiteQueueClient(poll_interval=0.01)
+
+
+def run(worker, condition, timeout=2):
+    worker.start()
+    deadline = time.monotonic() + timeout
+    try:
+        while not condition():
+            assert time.monotonic() < deadline, 'condition not met in time'
+            time.sleep(0.01)
+    finally:
+        worker.stop()
+
+
+def test_handled_messages_are_deleted(client):
+    handled = []
+    client.send_message(QueueUrl='jobs', MessageBody='a')
+    client.send_message(QueueUrl='jobs', MessageBody='b')
+    run(QueueWorker(client, 'jobs', lambda m: handled.append(m['Body']), wait_time=0.05), lambda: len(handled) == 2)
+
+    assert handled == ['a', 'b']
+    assert client.receive_message(QueueUrl='jobs') == {}
+
+
+def test_failed_messages_are_retried(client):
+    attempts = []
+
+    def handler(message):
+        attempts.append(message['Attributes']['ApproximateReceiveCount'])
+        if len(attempts) == 1:
+            raise RuntimeError('S3 unavailable')
+
+    client.send_message(QueueUrl='jobs', MessageBody='a')
+    run(QueueWorker(client, 'jobs', handler, wait_time=0.05, visibility_timeout=0), lambda: len(attempts) == 2)
+
+    assert attempts == ['1', '2']
+    assert client.receive_message(QueueUrl='jobs') == {}
+
+
+def test_poison_messages_are_dead_lettered(client):
+    attempts = []
+
+    def handler(message):
+        attempts.append(message['Body'])
+        raise RuntimeError('cannot be predicted')
+
+    client.send_message(QueueUrl='jobs', MessageBody='poison')
+    worker = QueueWorker(client, 'jobs', handler, wait_time=0.05, visibility_timeout=0, max_receives=3,
+                         dead_letter_url='jobs-dead')
+    run(worker, lambda: client.receive_message(QueueUrl='jobs-dead', VisibilityTimeout=60) != {})
+
+    assert attempts == ['poison'] * 3
+    assert client.receive_message(QueueUrl='jobs') == {}
+
+
+def test_poison_messages_are_dropped_without_a_dead_letter_queue(client):
+    attempts = []
+
+    def handler(message):
+        attempts.append(message['Body'])
+        raise RuntimeError('cannot be predicted')
+
+    deleted = []
+    delete_message = client.delete_message
+    client.delete_message = lambda **kwargs: deleted.append(kwargs) or delete_message(**kwargs)
+
+    client.send_message(QueueUrl='jobs', MessageBody='poison')
+    worker = QueueWorker(client, 'jobs', handler, wait_time=0.05, visibility_timeout=0, max_receives=2)
+    run(worker, lambda: deleted)
+
+    assert attempts == ['poison'] * 2
+    assert client.receive_message(QueueUrl='jobs') == {}
@@ -0,0 +1,76 @@
+import threading
+
+from loguru import logger
+
+
+class QueueWorker:
+    """
+    Consumes prediction jobs from an SQS compatible queue (see job_queue.py) at the pace of this yolo5 replica.
+    A message is deleted only once handler(message) returned, if the handler raises, the message becomes visible
+    again after the visibility timeout and is retried, possibly by another replica.
+    A message received more than max_receives times (a job that always fails, or kills the replica) is not handled
+    again: it is moved to the dead_letter_url queue if given, else dropped.
+    """
+
+    def __init__(self, client, queue_url, handler, num_threads=1, wait_time=20, visibility_timeout=60,
+                 max_receives=5, dead_letter_url=None):
+        self.client = client
+        self.queue_url = queue_url
+        self.handler = handler
+        self.num_threads = num_threads
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.max_receives = max_receives
+        self.dead_letter_url = dead_letter_url
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name=f'queue-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f'queue worker: consuming {self.queue_url} with {self.num_threads} threads')
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                response = self.client.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=1,
+                    WaitTimeSeconds=self.wait_time,
+                    VisibilityTimeout=self.visibility_timeout,
+                    AttributeNames=['ApproximateReceiveCount'],
+                )
+            except Exception:
+                logger.exception('queue worker: receive failed')
+                self._stop.wait(1)
+                continue
+
+            for message in response.get('Messages', []):
+                receives = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+                if receives > self.max_receives:
+                    self._dead_letter(message, receives)
+                    continue
+                try:
+                    self.handler(message)
+                except Exception:
+                    logger.exception(f'queue worker: job {message["MessageId"]} failed, it will be retried')
+                    continue
+                self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+    def _dead_letter(self, message, receives):
+        try:
+            if self.dead_letter_url:
+                self.client.send_message(QueueUrl=self.dead_letter_url, MessageBody=message['Body'])
+            self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+        except Exception:
+            logger.exception(f'queue worker: job {message["MessageId"]} could not be removed from the queue')
+            return
+        logger.error(f'queue worker: job {message["MessageId"]} received {receives} times, '
+                     f'{"moved to the dead letter queue" if self.dead_letter_url else "dropped"}: {message["Body"]}')
@@ -0,0 +1,57 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+from metrics import span
+
+
+class WriteBehindUploader:
+    """
+    Uploads objects to S3 in background threads, off the response path of /predict.
+    At most max_pending uploads are queued, submit() blocks beyond that so a slow S3 can't exhaust memory.
+    """
+
+    def __init__(self, s3, bucket, max_workers=4, max_pending=64):
+        self.s3 = s3
+        self.bucket = bucket
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='write-behind')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._stats = {'pending': 0, 'uploaded': 0, 'failed': 0}
+
+    def submit(self, object_name, body):
+        """
+        Queues an upload of object_name.
+        :param body: the content as bytes, or a callable returning it (bytes or a binary file-like object),
+                     so that encoding the content also happens in the background
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._stats['pending'] += 1
+        self._executor.submit(self._upload, object_name, body)
+
+    def _upload(self, object_name, body):
+        try:
+            with span('encode'):
+                content = body() if callable(body) else body
+            fileobj = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+            with span('s3_upload'):
+                self.s3.upload_fileobj(fileobj, self.bucket, object_name)
+            outcome = 'uploaded'
+        except Exception as e:
+            logger.error(f'write-behind: upload of {object_name} failed: {e}')
+            outcome = 'failed'
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            self._stats['pending'] -= 1
+            self._stats[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)